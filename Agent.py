@@ -1,10 +1,12 @@
+import copy
 import math
 import random
+import threading
 import numpy as np
 import torch
 import torch.optim as optim
 import torch.nn.functional as F
-from Utils.ReplayMemory import Transition, ReplayMemory
+from Utils.ReplayMemory import Transition, ReplayMemory, PrioritizedReplayMemory, MappedReplayMemory
 from datetime import datetime
 from torch import nn
 from torch.nn.functional import relu
@@ -31,6 +33,24 @@ class DQN(nn.Module):
         output = self.out(x.view(x.size(0), -1))
         return output
 
+    def shape(self):
+        return tuple(tuple(param.shape) for param in self.parameters())
+
+    @staticmethod
+    def stacked_forward(nets, x):
+        '''
+        Forward pass of different nets of the same shape in one batch, row i of x is evaluated by nets[i].
+        The weights are stacked and every layer is a single batched matrix product.
+        '''
+        x = x.unsqueeze(1)
+        for k in range(len(nets[0].hidden)):
+            weight = torch.stack([net.hidden[k].weight for net in nets]).transpose(1, 2)
+            bias = torch.stack([net.hidden[k].bias for net in nets]).unsqueeze(1)
+            x = relu(torch.baddbmm(bias, x, weight))
+        weight = torch.stack([net.out.weight for net in nets]).transpose(1, 2)
+        bias = torch.stack([net.out.bias for net in nets]).unsqueeze(1)
+        return torch.baddbmm(bias, x, weight).squeeze(1)
+
 class Agent():
     @abstractmethod
     def add_to_memory(self, state, action, next_state, reward):
@@ -45,7 +65,7 @@ class Agent():
         pass
 
     @abstractmethod
-    def _compute_loss(self, state_batch, action_batch, next_state_batch, reward_batch):
+    def _compute_loss(self, state_batch, action_batch, next_state_batch, reward_batch, weights=None):
         pass
 
     @abstractmethod
@@ -83,61 +103,104 @@ class DQN_Agent(Agent):
         # Deep q networks params
         self.layers = args.layers
         self.batch_size = args.batch_size
-        self.policy_net = DQN(state_size, n_actions, layers=self.layers).to(self.device).float()
+        self.policy_net = self._build_net().to(self.device).float()
+        # Net used by select_action, a published copy of the policy net when learning runs on another thread
+        self.acting_net = self.policy_net
         self.target_net = None
         self.grad_clip = args.grad_clip
 
         if str(args.optimizer).lower() == 'adam':
             self.optimizer = optim.Adam(self.policy_net.parameters())
-        if str(args.optimizer).lower() == 'rmsprop':
+        elif str(args.optimizer).lower() == 'rmsprop':
             self.optimizer = optim.RMSprop(self.policy_net.parameters())
         else:
             raise NotImplementedError
 
-        self.memory = ReplayMemory(args.replay_size)
+        self.prioritized = args.prioritized_replay
+        if args.replay_backend == 'mmap':
+            if self.prioritized:
+                raise NotImplementedError("prioritized_replay is not supported with replay_backend = mmap")
+            self.memory = MappedReplayMemory(args.replay_size, state_size, args.replay_path)
+        elif self.prioritized:
+            self.memory = PrioritizedReplayMemory(args.replay_size, state_size, alpha=args.per_alpha,
+                                                  beta=args.per_beta, beta_increment=args.per_beta_increment)
+        else:
+            self.memory = ReplayMemory(args.replay_size, state_size)
+        self.memory_lock = threading.Lock()
 
         # Performance buffers.
         self.rewards_list = []
 
+    def _build_net(self):
+        return DQN(self.state_size, self.n_actions, layers=self.layers)
+
+    def enable_async(self):
+        '''
+        Act with a copy of the policy net so optimize_model can run on another thread, see Utils.AsyncLearner.
+        '''
+        self.acting_net = copy.deepcopy(self.policy_net)
+
+    def publish(self):
+        '''
+        Refresh the acting net with the current policy weights, the reference swap is atomic for the acting thread.
+        '''
+        if self.acting_net is not self.policy_net:
+            self.acting_net = copy.deepcopy(self.policy_net)
+
+    def model_input(self, state):
+        '''
+        Converts a junction state into the input of the policy net.
+        '''
+        return state
+
     def add_to_memory(self, state, action, next_state, reward):
         self.rewards_list.append(reward)
-        state = torch.from_numpy(state).float()
-        action = torch.tensor([action])
-        next_state = torch.from_numpy(next_state).float()
-        reward = torch.tensor([reward])
-        self.memory.push(state, action, next_state, reward)
+        with self.memory_lock:
+            self.memory.push(state, int(action), next_state, reward)
 
-    def select_action(self, state):
+    def explore(self):
+        '''
+        Epsilon greedy step, returns True when a random action should be taken.
+        '''
         sample = random.random()
         self.eps_threshold = self.eps_end + (self.eps_start - self.eps_end) * \
                         math.exp(-1. * self.steps_done / self.eps_decay)
         self.steps_done += 1
-        if sample > self.eps_threshold:
-            with torch.no_grad():
-                # t.max(1) will return largest column value of each row.
-                # second column on max result is index of where max element was
-                # found, so we pick action with the larger expected reward.
-                state = torch.from_numpy(state).float().to(self.device) # Convert to tensor.
-                state = state.unsqueeze(0) # Add batch dimension.
-                return self.policy_net(state).max(1)[1].view(1, 1)
-        else:
-            return torch.tensor([[random.randrange(self.n_actions)]], device=self.device, dtype=torch.long).item()
+        return sample <= self.eps_threshold
+
+    def select_action(self, state):
+        if self.explore():
+            return random.randrange(self.n_actions)
+        with torch.no_grad():
+            # t.max(1) will return largest column value of each row.
+            # second column on max result is index of where max element was
+            # found, so we pick action with the larger expected reward.
+            state = torch.from_numpy(state).float().to(self.device) # Convert to tensor.
+            state = state.unsqueeze(0) # Add batch dimension.
+            return self.acting_net(state).max(1)[1].item()
 
     def optimize_model(self):
         if len(self.memory) < self.batch_size:
             return
-        transitions = self.memory.sample(self.batch_size)
-        # This converts batch-array of Transitions
-        # to Transition of batch-arrays.
-        batch = Transition(*zip(*transitions))
+        # Transition of batch tensors.
+        weights = None
+        with self.memory_lock:
+            if self.prioritized:
+                batch, indices, weights = self.memory.sample_prioritized(self.batch_size)
+                weights = weights.to(self.device)
+            else:
+                batch = self.memory.sample(self.batch_size)
 
-        next_states_batch = torch.cat(batch.next_state).view(self.batch_size, -1).to(self.device)
-        state_batch = torch.cat(batch.state).view(self.batch_size, -1).to(self.device)
-        action_batch = torch.cat(batch.action).view(self.batch_size, -1).to(self.device)
-        reward_batch = torch.cat(batch.reward).view(self.batch_size, -1).to(self.device)
+        next_states_batch = batch.next_state.to(self.device)
+        state_batch = batch.state.to(self.device)
+        action_batch = batch.action.to(self.device)
+        reward_batch = batch.reward.to(self.device)
 
         # Compute loss
-        loss = self._compute_loss(state_batch, action_batch, next_states_batch, reward_batch)
+        loss, td_errors = self._compute_loss(state_batch, action_batch, next_states_batch, reward_batch, weights)
+        if self.prioritized:
+            with self.memory_lock:
+                self.memory.update_priorities(indices, td_errors.cpu().numpy())
 
         # Optimize the model
         self.optimizer.zero_grad()
@@ -154,7 +217,7 @@ class DQN_Agent(Agent):
         # update Target net weights
         self._update_target()
 
-    def _compute_loss(self, state_batch, action_batch, next_states_batch, reward_batch):
+    def _compute_loss(self, state_batch, action_batch, next_states_batch, reward_batch, weights=None):
         # Compute Q(s_t, a) - the model computes Q(s_t), then we select the
         # columns of actions taken. These are the actions which would've been taken
         # for each batch state according to policy_net
@@ -167,8 +230,17 @@ class DQN_Agent(Agent):
         expected_state_action_values = (next_state_values.unsqueeze(1) * self.discount) + reward_batch
 
         # Compute Huber loss
-        loss = F.smooth_l1_loss(state_action_values, expected_state_action_values)
-        return loss
+        return self._huber_loss(state_action_values, expected_state_action_values, weights)
+
+    def _huber_loss(self, state_action_values, expected_state_action_values, weights=None):
+        '''
+        :return: Huber loss, weighted by the importance sampling weights if given, and the TD errors
+        '''
+        loss = F.smooth_l1_loss(state_action_values, expected_state_action_values, reduction='none')
+        if weights is not None:
+            loss = loss * weights
+        td_errors = (expected_state_action_values - state_action_values).detach().squeeze(1)
+        return loss.mean(), td_errors
 
     def _update_target(self):
         if self.target_net is None:
@@ -198,6 +270,41 @@ class DQN_Agent(Agent):
         ckpt_path = os.path.join(ckpt_folder, 'policy_net_state_dict.pth')
         torch.save(self.policy_net.state_dict(), ckpt_path)
 
+    def load_ckpt(self, ckpt_folder):
+        '''
+        loads a checkpoint saved by save_ckpt into the policy net, and the target net if any.
+        :param ckpt_folder: path to a folder.
+        '''
+        ckpt_path = os.path.join(ckpt_folder, 'policy_net_state_dict.pth')
+        self.policy_net.load_state_dict(torch.load(ckpt_path, map_location=self.device))
+        if self.target_net is not None:
+            self.target_net.load_state_dict(self.policy_net.state_dict())
+        self.publish()
+
+    def training_state(self):
+        '''
+        Copy of everything needed to resume training: nets, optimizer, exploration schedule and replay memory.
+        The copy can be written on another thread while training goes on, see Utils.Checkpoint.
+        :return: (dict for torch.save, replay memory state_dict)
+        '''
+        state = {'policy_net': copy.deepcopy(self.policy_net.state_dict()),
+                 'target_net': None if self.target_net is None else copy.deepcopy(self.target_net.state_dict()),
+                 'optimizer': copy.deepcopy(self.optimizer.state_dict()),
+                 'steps_done': self.steps_done}
+        with self.memory_lock:
+            memory = self.memory.state_dict()
+        return state, memory
+
+    def load_training_state(self, state, memory):
+        self.policy_net.load_state_dict(state['policy_net'])
+        if self.target_net is not None and state['target_net'] is not None:
+            self.target_net.load_state_dict(state['target_net'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        self.steps_done = state['steps_done']
+        with self.memory_lock:
+            self.memory.load_state_dict(memory)
+        self.publish()
+
 class Fixed_Q_Targets_Agent(DQN_Agent):
     '''
     This agent implements Fixed Q-Targets algorithm. There are two deep networks.
@@ -206,11 +313,11 @@ class Fixed_Q_Targets_Agent(DQN_Agent):
     '''
     def __init__(self, state_size, n_actions, args, device=torch.device("cuda" if torch.cuda.is_available() else "cpu")):
         super().__init__(state_size, n_actions, args, device=device)
-        self.target_net = DQN(state_size, n_actions, layers=self.layers).to(self.device)
+        self.target_net = self._build_net().to(self.device)
         self.target_net.load_state_dict(self.policy_net.state_dict())
         self.target_net.eval()
 
-    def _compute_loss(self, state_batch, action_batch, next_states_batch, reward_batch):
+    def _compute_loss(self, state_batch, action_batch, next_states_batch, reward_batch, weights=None):
         # Compute Q(s_t, a) - the model computes Q(s_t), then we select the
         # columns of actions taken. These are the actions which would've been taken
         # for each batch state according to policy_net
@@ -227,8 +334,7 @@ class Fixed_Q_Targets_Agent(DQN_Agent):
         expected_state_action_values = (next_state_values.unsqueeze(1) * self.discount) + reward_batch
 
         # Compute Huber loss
-        loss = F.smooth_l1_loss(state_action_values, expected_state_action_values)
-        return loss
+        return self._huber_loss(state_action_values, expected_state_action_values, weights)
 
 class Double_DQN_Agent(DQN_Agent):
     '''
@@ -247,11 +353,11 @@ class Double_DQN_Agent(DQN_Agent):
     '''
     def __init__(self, state_size, n_actions, args, device=torch.device("cuda" if torch.cuda.is_available() else "cpu")):
         super().__init__(state_size, n_actions, args, device=device)
-        self.target_net = DQN(state_size, n_actions, layers=self.layers).to(self.device)
+        self.target_net = self._build_net().to(self.device)
         self.target_net.load_state_dict(self.policy_net.state_dict())
         self.target_net.eval()
 
-    def _compute_loss(self, state_batch, action_batch, next_states_batch, reward_batch):
+    def _compute_loss(self, state_batch, action_batch, next_states_batch, reward_batch, weights=None):
         # Q{policy net}(s, a)
         state_action_q_values = self.policy_net(state_batch).gather(1, action_batch)
 
@@ -265,8 +371,173 @@ class Double_DQN_Agent(DQN_Agent):
         expected_state_action_values = (next_state_q_values * self.discount) + reward_batch
 
         # Compute Huber loss
-        loss = F.smooth_l1_loss(state_action_q_values, expected_state_action_values)
-        return loss
+        return self._huber_loss(state_action_q_values, expected_state_action_values, weights)
+
+class JunctionEmbeddingDQN(DQN):
+    '''
+    DQN shared by several junctions. The last input column holds the junction index,
+    it is replaced by a learned embedding of the junction before the hidden layers.
+    '''
+    def __init__(self, inputs, outputs, layers=[128, 64, 16], num_junctions=1, embedding_size=8):
+        super(JunctionEmbeddingDQN, self).__init__(inputs - 1 + embedding_size, outputs, layers=layers)
+        self.embedding = nn.Embedding(num_junctions, embedding_size)
+
+    def forward(self, x):
+        junctions = x[:, -1].long()
+        x = torch.cat((x[:, :-1], self.embedding(junctions)), dim=1)
+        return super(JunctionEmbeddingDQN, self).forward(x)
+
+
+class Shared_Double_DQN_Agent(Double_DQN_Agent):
+    '''
+    One Double DQN agent for all the junctions of a network: one policy net, one target net, one optimizer
+    and one replay memory holding the transitions of every junction.
+    States are padded to the widest junction state and end with the junction index (see Shared_Agent_View),
+    n_actions is the max number of phases, actions a junction does not have are masked out of the targets.
+    Trains one batch of batch_size samples per junction.
+    steps_done advances once every num_junctions decisions, so eps_decay and the hard target updates
+    keep the pace they have with one agent per junction.
+    '''
+    def __init__(self, state_size, n_actions, args, junctions_actions, embedding_size=8,
+                 device=torch.device("cuda" if torch.cuda.is_available() else "cpu")):
+        self.num_junctions = len(junctions_actions)
+        self.embedding_size = embedding_size
+        super().__init__(state_size, n_actions, args, device=device)
+        self.batch_size = args.batch_size * self.num_junctions
+        self.junctions_actions = torch.tensor(junctions_actions, device=self.device)
+        # Decisions of all the junctions
+        self.decisions = 0
+
+    def explore(self):
+        '''
+        Epsilon greedy step of one junction decision, see Shared_Agent_View.
+        '''
+        sample = random.random()
+        self.eps_threshold = self.eps_end + (self.eps_start - self.eps_end) * \
+                        math.exp(-1. * self.steps_done / self.eps_decay)
+        self.decisions += 1
+        if self.decisions % self.num_junctions == 0:
+            self.steps_done += 1
+        return sample <= self.eps_threshold
+
+    def load_training_state(self, state, memory):
+        super().load_training_state(state, memory)
+        self.decisions = self.steps_done * self.num_junctions
+
+    def save_ckpt(self, ckpt_folder, junction_index=None):
+        '''
+        saves the policy net and its architecture in ckpt_folder/shared_policy_net.pth, see Greedy_Agent.load_ckpt
+        :param junction_index: index of the junction the folder belongs to
+        '''
+        ckpt_path = os.path.join(ckpt_folder, 'shared_policy_net.pth')
+        torch.save({'policy_net': self.policy_net.state_dict(),
+                    'state_size': self.state_size,
+                    'n_actions': self.n_actions,
+                    'layers': self.layers,
+                    'junctions_actions': self.junctions_actions.tolist(),
+                    'embedding_size': self.embedding_size,
+                    'junction_index': junction_index}, ckpt_path)
+
+    def _build_net(self):
+        return JunctionEmbeddingDQN(self.state_size, self.n_actions, layers=self.layers,
+                                    num_junctions=self.num_junctions, embedding_size=self.embedding_size)
+
+    def _mask(self, q_values, states):
+        invalid = torch.arange(self.n_actions, device=self.device).unsqueeze(0) >= \
+                  self.junctions_actions[states[:, -1].long()].unsqueeze(1)
+        return q_values.masked_fill(invalid, -float('inf'))
+
+    def _compute_loss(self, state_batch, action_batch, next_states_batch, reward_batch, weights=None):
+        # Q{policy net}(s, a)
+        state_action_q_values = self.policy_net(state_batch).gather(1, action_batch)
+
+        # argmax{a} Q{policy net}(s', a') over the actions of the junction
+        next_state_actions = torch.argmax(self._mask(self.policy_net(next_states_batch), next_states_batch), dim=1).unsqueeze(1)
+
+        # Q{target net}(s', argmax{a} Q{policy net}(s', a') )
+        next_state_q_values = self.target_net(next_states_batch).gather(1, next_state_actions)
+
+        # Q* = Disount * Q(s', argmax(..)) + R
+        expected_state_action_values = (next_state_q_values * self.discount) + reward_batch
+
+        # Compute Huber loss
+        return self._huber_loss(state_action_q_values, expected_state_action_values, weights)
+
+
+class Shared_Agent_View(Agent):
+    '''
+    The junction side of a Shared_Double_DQN_Agent. Pads the junction states to the shared state width
+    and appends the junction index. Training is done once per step for all the junctions by the owner
+    of the shared agent, so optimize_model does nothing here.
+    '''
+    def __init__(self, shared, junction_index, n_actions):
+        self.shared = shared
+        self.junction_index = junction_index
+        self.n_actions = n_actions
+        self.device = shared.device
+
+    @property
+    def acting_net(self):
+        return self.shared.acting_net
+
+    def model_input(self, state):
+        padded = np.zeros(self.shared.state_size, dtype=np.float32)
+        padded[:len(state)] = state
+        padded[-1] = self.junction_index
+        return padded
+
+    def explore(self):
+        return self.shared.explore()
+
+    def add_to_memory(self, state, action, next_state, reward):
+        self.shared.add_to_memory(self.model_input(state), action, self.model_input(next_state), reward)
+
+    def select_action(self, state):
+        return select_actions([self], [state])[0]
+
+    def optimize_model(self):
+        return
+
+    def _compute_loss(self, state_batch, action_batch, next_state_batch, reward_batch, weights=None):
+        return self.shared._compute_loss(state_batch, action_batch, next_state_batch, reward_batch, weights)
+
+    def _update_target(self):
+        return
+
+    def save_ckpt(self, ckpt_folder):
+        self.shared.save_ckpt(ckpt_folder, self.junction_index)
+
+
+def select_actions(agents, states):
+    '''
+    Select the actions of several agents at once.
+    Exploration is decided per agent, the states of the greedy DQN agents are grouped by the shape of
+    their policy net and every group is evaluated in one forward pass.
+    Agents of other types select their action one by one.
+    :return: list of int actions
+    '''
+    actions = [None] * len(agents)
+    groups = dict()
+    for i, (agent, state) in enumerate(zip(agents, states)):
+        if not isinstance(agent, (DQN_Agent, Shared_Agent_View)):
+            actions[i] = agent.select_action(state)
+        elif agent.explore():
+            actions[i] = random.randrange(agent.n_actions)
+        else:
+            key = (type(agent.acting_net), agent.acting_net.shape(), agent.device)
+            groups.setdefault(key, list()).append(i)
+    with torch.no_grad():
+        for (_, _, device), group in groups.items():
+            nets = [agents[i].acting_net for i in group]
+            batch = torch.from_numpy(np.stack([agents[i].model_input(states[i]) for i in group])).float().to(device)
+            if all(net is nets[0] for net in nets):
+                q_values = nets[0](batch)
+            else:
+                q_values = DQN.stacked_forward(nets, batch)
+            for row, i in enumerate(group):
+                # A shared net may have more outputs than the phases of this junction
+                actions[i] = q_values[row, :agents[i].n_actions].argmax().item()
+    return actions
 
 class Stupid_Agent():
     def __init__(self, n_actions=4):
@@ -279,6 +550,10 @@ class Stupid_Agent():
     def optimize_model(self):
         return
 
+    def save_ckpt(self, ckpt_folder):
+        # Nothing is learned.
+        return
+
     def add_to_memory(self, state, action, next_state, reward):
         # This method used only for saving the reward.
         self.rewards_list.append(reward)
@@ -304,6 +579,51 @@ class Random_Agent(Stupid_Agent):
         return randrange(self.n_actions)
 
 
+class Greedy_Agent(Stupid_Agent):
+    '''
+    This agent takes the best action of a trained policy net, for evaluation.
+    No exploration, no replay memory and no optimizer.
+    Loads the checkpoints of a DQN agent, or the ones of a Shared_Double_DQN_Agent, whose net is rebuilt
+    from the saved architecture and fed the padded state and the junction index.
+    '''
+    def __init__(self, state_size, n_actions, layers, device=torch.device("cuda" if torch.cuda.is_available() else "cpu")):
+        super().__init__(n_actions)
+        self.device = device
+        self.state_size = state_size
+        self.policy_net = DQN(state_size, n_actions, layers=layers).to(self.device).float().eval()
+        # Set when a shared agent checkpoint is loaded
+        self.shared_state_size = None
+        self.junction_index = None
+
+    def load_ckpt(self, ckpt_folder):
+        shared_path = os.path.join(ckpt_folder, 'shared_policy_net.pth')
+        if os.path.exists(shared_path):
+            ckpt = torch.load(shared_path, map_location=self.device)
+            self.policy_net = JunctionEmbeddingDQN(ckpt['state_size'], ckpt['n_actions'], layers=ckpt['layers'],
+                                                   num_junctions=len(ckpt['junctions_actions']),
+                                                   embedding_size=ckpt['embedding_size']).to(self.device).float().eval()
+            self.policy_net.load_state_dict(ckpt['policy_net'])
+            self.shared_state_size = ckpt['state_size']
+            self.junction_index = ckpt['junction_index']
+            return
+        ckpt_path = os.path.join(ckpt_folder, 'policy_net_state_dict.pth')
+        self.policy_net.load_state_dict(torch.load(ckpt_path, map_location=self.device))
+
+    def model_input(self, state):
+        if self.junction_index is None:
+            return state
+        padded = np.zeros(self.shared_state_size, dtype=np.float32)
+        padded[:len(state)] = state
+        padded[-1] = self.junction_index
+        return padded
+
+    def select_action(self, state):
+        with torch.inference_mode():
+            state = torch.from_numpy(self.model_input(state)).float().to(self.device).unsqueeze(0)
+            # A shared net may have more outputs than the phases of this junction
+            return self.policy_net(state)[:, :self.n_actions].argmax(1).item()
+
+
 class Cyclic_Agent(Stupid_Agent):
     '''
     This agent only change the phases repeatedly in a cycle.
@@ -4,12 +4,16 @@
 
 from Utils.ArgParser import process_arguments
 from Simularor import Simulator
+from Distributed import DistributedTrainer
 #from Utils.Logging import Logger
 
 
 
 if __name__ == '__main__':
     args = process_arguments()
-    simulator = Simulator(args)
+    if args.actors > 0:
+        DistributedTrainer(args).run()
+    else:
+        simulator = Simulator(args)
 
-    simulator.run()
+        simulator.run()
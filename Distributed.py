@@ -0,0 +1,212 @@
+import copy
+import ctypes
+import os
+import sys
+import time
+import multiprocessing
+import numpy as np
+import torch
+from torch.nn.utils import parameters_to_vector, vector_to_parameters
+from Agent import DQN_Agent, Double_DQN_Agent
+from Simularor import Simulator
+from TrafficNetwork import Junction
+from Utils.AgentParams import AgentParams
+from Utils.Logging import Logging
+from Utils.Topology import Topology
+
+
+class SharedTransitions:
+    '''
+    Ring of transitions in shared memory, written by one actor and drained by the learner without pickling.
+    written counts all the transitions ever pushed, the learner keeps its own read position.
+    Every slot has a sequence number, 2 * index + 1 while transition index is written in it and 2 * index + 2
+    once it is complete: the learner copies a row only when it holds the complete transition it expects
+    and drops it if the sequence changed during the copy (overwritten by the actor meanwhile).
+    '''
+    def __init__(self, capacity, state_size, context):
+        self.capacity = capacity
+        self.state_size = state_size
+        self.states = context.RawArray(ctypes.c_float, capacity * state_size)
+        self.actions = context.RawArray(ctypes.c_int64, capacity)
+        self.next_states = context.RawArray(ctypes.c_float, capacity * state_size)
+        self.rewards = context.RawArray(ctypes.c_float, capacity)
+        self.sequences = context.RawArray(ctypes.c_int64, capacity)
+        self.written = context.RawValue(ctypes.c_int64, 0)
+        self.read = 0
+
+    def arrays(self):
+        shape = (self.capacity, self.state_size)
+        return (np.frombuffer(self.states, dtype=np.float32).reshape(shape),
+                np.frombuffer(self.actions, dtype=np.int64),
+                np.frombuffer(self.next_states, dtype=np.float32).reshape(shape),
+                np.frombuffer(self.rewards, dtype=np.float32))
+
+    def push(self, state, action, next_state, reward):
+        states, actions, next_states, rewards = self.arrays()
+        index = self.written.value
+        position = index % self.capacity
+        self.sequences[position] = 2 * index + 1
+        states[position] = state
+        actions[position] = action
+        next_states[position] = next_state
+        rewards[position] = reward
+        self.sequences[position] = 2 * index + 2
+        # Published only after the row is complete
+        self.written.value = index + 1
+
+    def drain(self, memory):
+        """ Push the new transitions into memory, transitions overwritten before being read are lost """
+        written = self.written.value
+        self.read = max(self.read, written - self.capacity)
+        states, actions, next_states, rewards = self.arrays()
+        drained = 0
+        for index in range(self.read, written):
+            position = index % self.capacity
+            sequence = self.sequences[position]
+            if sequence != 2 * index + 2:
+                continue
+            row = (states[position].copy(), int(actions[position]), next_states[position].copy(), float(rewards[position]))
+            if self.sequences[position] != sequence:
+                continue
+            memory.push(*row)
+            drained += 1
+        self.read = written
+        return drained
+
+
+class SharedWeights:
+    '''
+    Flat copy of a policy net in shared memory with a version counter, written by the learner and read by the actors.
+    '''
+    def __init__(self, net, context):
+        self.size = parameters_to_vector(net.parameters()).numel()
+        self.weights = context.RawArray(ctypes.c_float, self.size)
+        self.version = context.RawValue(ctypes.c_int64, 0)
+        self.lock = context.Lock()
+        self.loaded = 0
+
+    def publish(self, net):
+        with self.lock:
+            np.frombuffer(self.weights, dtype=np.float32)[:] = parameters_to_vector(net.parameters()).detach().cpu().numpy()
+            self.version.value += 1
+
+    def load(self, net):
+        """ Load the weights into net if a newer version was published """
+        if self.version.value == self.loaded:
+            return
+        with self.lock:
+            vector = torch.from_numpy(np.frombuffer(self.weights, dtype=np.float32).copy())
+            self.loaded = self.version.value
+        with torch.no_grad():
+            vector_to_parameters(vector.to(next(net.parameters()).device), net.parameters())
+
+
+class ActorMemory:
+    '''
+    Replay memory of an actor agent: transitions go to the learner, and the latest published
+    weights are loaded into the acting policy net on the way.
+    '''
+    def __init__(self, transitions, weights, agent):
+        self.transitions = transitions
+        self.weights = weights
+        self.agent = agent
+
+    def push(self, state, action, next_state, reward):
+        self.transitions.push(state, action, next_state, reward)
+        self.weights.load(self.agent.policy_net)
+
+    def __len__(self):
+        return 0
+
+
+def actor_process(args, index, transitions, weights):
+    '''
+    Runs one Simulator with its own TraCI label, seed and logs, acting with the broadcast weights.
+    '''
+    args.label = args.label + "_actor_" + str(index)
+    args.seed = (0 if args.seed is None else args.seed) + index
+    args.log_root = os.path.join(args.log_root, "actor_" + str(index))
+    args.learn = False
+    args.async_learn = False
+    args.animation = False
+    simulator = Simulator(args)
+    for junction in simulator.traffic_network.junctions:
+        weights[junction.jid].load(junction.agent.policy_net)
+        junction.agent.memory = ActorMemory(transitions[junction.jid], weights[junction.jid], junction.agent)
+    simulator.run()
+
+
+class DistributedTrainer:
+    '''
+    Ape-X style training: args.actors processes run their own SUMO and stream transitions through shared memory
+    to the learner (this process), which owns the agents of every junction and trains them.
+    The learner broadcasts the policy weights back every args.actor_sync updates.
+    '''
+    def __init__(self, args):
+        if args.agent not in ('dqn', 'double_dqn'):
+            sys.exit("distributed training needs -ag dqn or -ag double_dqn")
+        if args.shared_agent:
+            sys.exit("distributed training does not support --shared-agent")
+        self.args = args
+        if self.args.log_root is None:
+            self.args.log_root = os.path.join(args.network, 'logs', time.strftime('%Y_%m_%d__%H_%M_%S', time.localtime()))
+        self.learner_root = os.path.join(self.args.log_root, "learner")
+        self.logger = Logging(logfile=os.path.join(self.learner_root, "prints"), name="Learner", stdout=True)
+        self.logger.set_new_file("learner")
+        # The learner never runs SUMO, it only needs the agents
+        self.agents = self.create_agents()
+        # Actors are spawned, torch state and SUMO connections must not be forked
+        self.context = multiprocessing.get_context('spawn')
+        capacity = max(agent.memory.capacity for agent in self.agents.values())
+        self.transitions = [dict((jid, SharedTransitions(capacity, agent.state_size, self.context)) for jid, agent in self.agents.items())
+                            for _ in range(self.args.actors)]
+        self.weights = dict((jid, SharedWeights(agent.policy_net, self.context)) for jid, agent in self.agents.items())
+        for jid, agent in self.agents.items():
+            self.weights[jid].publish(agent.policy_net)
+        self.updates = 0
+
+    def create_agents(self):
+        """ One agent per junction, built as TrafficNetwork does from the cached topology """
+        topology = Topology(self.args.cfg)
+        agent_class = Double_DQN_Agent if self.args.agent == 'double_dqn' else DQN_Agent
+        agents = dict()
+        for jid in topology.tls_ids():
+            params = AgentParams(Junction.config_file_of(self.args, jid), self.args.agent_params)
+            if params.replay_path is None:
+                params.replay_path = Junction.replay_path(self.learner_root, jid)
+            agents[jid] = agent_class(Junction.input_size_of(topology, jid), len(topology.phases(jid)), params)
+            if self.args.pretrained is not None:
+                agents[jid].load_ckpt(Junction.pretrained_folder_of(self.args.pretrained, jid))
+        return agents
+
+    def run(self):
+        actors = [self.context.Process(target=actor_process, args=(copy.copy(self.args), i, self.transitions[i], self.weights))
+                  for i in range(self.args.actors)]
+        for actor in actors:
+            actor.start()
+        start = time.time()
+        received = 0
+        while any(actor.is_alive() for actor in actors):
+            drained = 0
+            for actor_transitions in self.transitions:
+                for jid, ring in actor_transitions.items():
+                    with self.agents[jid].memory_lock:
+                        drained += ring.drain(self.agents[jid].memory)
+            received += drained
+            if drained == 0 and all(len(agent.memory) < agent.batch_size for agent in self.agents.values()):
+                time.sleep(0.01)
+                continue
+            for agent in self.agents.values():
+                agent.optimize_model()
+            self.updates += 1
+            if self.updates % self.args.actor_sync == 0:
+                for jid, agent in self.agents.items():
+                    self.weights[jid].publish(agent.policy_net)
+                self.logger.info(str(self.updates) + " updates, " +
+                                 str(round(received / (time.time() - start), 1)) + " transitions/s")
+        for actor in actors:
+            actor.join()
+        for jid, agent in self.agents.items():
+            folder = os.path.join(self.learner_root, jid, "checkpoint")
+            os.makedirs(folder, exist_ok=True)
+            agent.save_ckpt(folder)
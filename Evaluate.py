@@ -0,0 +1,115 @@
+"""
+Greedy evaluation of the checkpoints of a training run.
+The policy net of every junction is loaded from <run>/<jid>/checkpoint (or <run>/<jid> for Surrogate.py weights)
+and acts greedily, without exploration, replay memory or optimizer, under torch.inference_mode.
+The checkpoints of a --shared-agent run are supported, every junction loads the shared net with its junction index.
+Evaluation episodes are never recorded in the metrics store.
+Every agent (greedy, cyclic and random baselines) runs the same K seeds, one process per (agent, seed).
+The per junction waiting time and speed statistics are averaged over the seeds and written to evaluation.csv.
+The other arguments are the DeepRLight ones (network, steps, parameters overrides...).
+"""
+import argparse
+import csv
+import os
+import time
+import multiprocessing
+import numpy as np
+import torch
+from concurrent.futures import ProcessPoolExecutor
+from Utils.ArgParser import process_arguments
+
+agents = ['greedy', 'cyclic', 'random']
+stats = ['mean_wt', 'max_wt', 'mean_speed', 'cars', 'reward']
+
+
+def run_evaluation(agent, seed, argv, run, root):
+    '''
+    One episode of every junction acting with agent.
+    :return: {jid: {stat: value}}
+    '''
+    from Simularor import Simulator
+    args = process_arguments(argv)
+    args.agent = agent
+    args.pretrained = run
+    args.seed = seed
+    args.label = "DeepRLight_eval_" + agent + "_" + str(seed)
+    args.log_root = os.path.join(root, agent, "seed_" + str(seed))
+    args.episodes = 1
+    args.learn = False
+    args.dump = True
+    args.animation = False
+    args.capture = False
+    args.gui = False
+    args.shared_agent = False
+    args.async_learn = False
+    args.metrics_db = None
+    with torch.inference_mode():
+        simulator = Simulator(args)
+        simulator.reset()
+        samples = dict((junction.jid, list()) for junction in simulator.traffic_network.junctions)
+        for _ in range(args.max_steps):
+            dumped = int(simulator.traffic_network.observation.time) % args.dump_interval == 0
+            simulator.step()
+            if not dumped:
+                continue
+            for jid, data in simulator.traffic_network.dump_data.items():
+                samples[jid].append((data['max_wt'], data['mean_speed'], data['cars']))
+        results = dict()
+        for junction in simulator.traffic_network.junctions:
+            values = np.array(samples[junction.jid], dtype=np.float64).reshape(-1, 3)
+            results[junction.jid] = {'mean_wt': values[:, 0].mean(), 'max_wt': values[:, 0].max(),
+                                     'mean_speed': values[:, 1].mean(), 'cars': values[:, 2].mean(),
+                                     'reward': np.mean(junction.episode_rewards)}
+        simulator.close()
+        # Records the episode and waits for the pending metrics writes, as Simulator.run
+        simulator.traffic_network.shutdown()
+        simulator.disconnect()
+    return results
+
+
+def aggregate(results):
+    '''
+    :param results: {(agent, seed): {jid: {stat: value}}}
+    :return: rows of agent, jid, then mean and std over the seeds of every stat
+    '''
+    rows = list()
+    for agent in agents:
+        runs = [result for (run_agent, _), result in sorted(results.items()) if run_agent == agent]
+        for jid in sorted(runs[0].keys()):
+            row = [agent, jid]
+            for stat in stats:
+                values = [run[jid][stat] for run in runs]
+                row += [round(float(np.mean(values)), 3), round(float(np.std(values)), 3)]
+            rows.append(row)
+    return rows
+
+
+def evaluate(run, seeds, workers, argv, root):
+    os.makedirs(root, exist_ok=True)
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        futures = dict(((agent, seed), pool.submit(run_evaluation, agent, seed, argv, run, root))
+                       for agent in agents for seed in seeds)
+        results = dict((key, future.result()) for key, future in futures.items())
+    rows = aggregate(results)
+    with open(os.path.join(root, "evaluation.csv"), "w", newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['agent', 'junction'] + [stat + suffix for stat in stats for suffix in ('_mean', '_std')])
+        writer.writerows(rows)
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="DeepRLight checkpoints evaluation, the other arguments are the DeepRLight ones")
+    parser.add_argument("run", type=str, help='Logs directory of the training run')
+    parser.add_argument("-k", "--seeds", type=int, default=4, dest="seeds", help='Number of seeds')
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(), dest="workers")
+    parser.add_argument("-o", "--output", type=str, default=None, dest="output",
+                        help='Evaluation directory, default: <run>/evaluation/<timestamp>')
+    eval_args, argv = parser.parse_known_args()
+    output = eval_args.output
+    if output is None:
+        output = os.path.join(eval_args.run, "evaluation", time.strftime('%Y_%m_%d__%H_%M_%S', time.localtime()))
+    base_seed = process_arguments(argv).seed or 0
+    for evaluation_row in evaluate(eval_args.run, range(base_seed, base_seed + eval_args.seeds), eval_args.workers, argv, output):
+        print(evaluation_row)
@@ -1,10 +1,15 @@
 
 from sumolib import checkBinary
-import traci
+from Utils.Backend import backend as traci
 import os
 import sys
 from TrafficNetwork import TrafficNetwork
+from Utils.SnapshotCache import SnapshotCache
+from Utils import Checkpoint
 import random
+import time
+import numpy as np
+import torch
 from tqdm import tqdm
 
 class Simulator:
@@ -14,8 +19,11 @@ class Simulator:
         self.sumo_cmd = None
         self.traffic_network = None
         self.steps = 0
-        self.heatup = 20
+        self.heatup = args.heatup
+        self.snapshots = None
         self.episode = 0
+        # (command, backend) of the running SUMO, None when there is no open connection
+        self.connection = None
 
         # init state
         if 'SUMO_HOME' in os.environ:
@@ -23,18 +31,56 @@ class Simulator:
             sys.path.append(tools)
         else:
             sys.exit("please declare environment variable 'SUMO_HOME'")
-        self.sumo_cmd = [checkBinary('sumo'), '-c', args.cfg,
-                         '--no-warnings']  # ,'--no-step-log',
-        traci.start(self.sumo_cmd, label='DeepRLight')
+        self.sumo_cli = [checkBinary('sumo'), '-c', self.args.cfg, '--no-warnings']  # ,'--no-step-log',
+        self.sumo_gui = [checkBinary('sumo-gui'), '-c', self.args.cfg, '--start', '--quit-on-end']
+        if self.args.seed is not None:
+            random.seed(self.args.seed)
+            np.random.seed(self.args.seed)
+            torch.manual_seed(self.args.seed)
+            self.sumo_cli += ['--seed', str(self.args.seed)]
+            self.sumo_gui += ['--seed', str(self.args.seed)]
+        self.sumo_cmd = self.sumo_cli
         view_dict, view_paths = self.parse_gui_settings()
+        # Built from the cached topology of the network, SUMO starts with the first episode
         self.traffic_network = TrafficNetwork(self.args, view_dict)
-        traci.close()
 
-        self.sumo_cli = [checkBinary('sumo'), '-c', self.args.cfg, '--no-warnings']
-        self.sumo_gui = [checkBinary('sumo-gui'), '-c', self.args.cfg, '--start', '--quit-on-end']
-        self.sumo_cmd = self.sumo_cli
         if self.args.gui:
             self.sumo_cmd = self.sumo_gui
+        if self.args.snapshots > 0:
+            self.snapshots = SnapshotCache(self.args.cfg, self.args.snapshots, self.heatup)
+        self.start_episode = 0
+        self.checkpoints = None
+        if self.args.learn and self.args.checkpoint_interval > 0 and len(self.traffic_network.checkpoint_agents()) > 0:
+            self.checkpoints = Checkpoint.CheckpointWriter(os.path.join(self.traffic_network.network_log_root, "resume"))
+        if self.args.resume is not None:
+            self.resume()
+
+    def resume(self):
+        """ Restore the last training state saved in the logs directory and continue after its episode """
+        folder = Checkpoint.latest(os.path.join(self.traffic_network.network_log_root, "resume"))
+        if folder is None:
+            sys.exit("no training state to resume in " + self.traffic_network.network_log_root)
+        network_state, agents_states = Checkpoint.load(folder)
+        self.traffic_network.load_training_state(network_state, agents_states)
+        self.start_episode = network_state['episode'] + 1
+
+    def connect(self, cmd, backend):
+        """
+        Start SUMO, in 'load' reset mode the running SUMO is reused and only reloads the scenario.
+        A restart is done only when the binary (sumo / sumo-gui) or the backend changes.
+        """
+        if self.connection == (cmd, backend):
+            traci.load(cmd[1:])
+        else:
+            self.disconnect()
+            traci.use(backend)
+            traci.start(cmd, label=self.args.label)
+            self.connection = (cmd, backend)
+
+    def disconnect(self):
+        if self.connection is not None:
+            traci.close()
+            self.connection = None
 
 
     def parse_gui_settings(self):
@@ -49,36 +95,87 @@ class Simulator:
         """
         if self.args.capture and (self.episode % self.args.episode_capture) == 0 :
             self.sumo_cmd = self.sumo_gui
+        elif self.args.gui:
+            self.sumo_cmd = self.sumo_gui
         else:
-            self.sumo_cmd = self.sumo_cmd
-        traci.start(self.sumo_cmd, label='DeepRLight')
+            self.sumo_cmd = self.sumo_cli
+        # sumo-gui (and so screenshots capture) is only available through the socket connection
+        self.connect(self.sumo_cmd, 'traci' if self.sumo_cmd is self.sumo_gui else self.args.backend)
+        if self.snapshots is not None and self.snapshots.is_full():
+            # Skip the heatup, start from one of the saved post heatup states
+            self.snapshots.load()
+            self.traffic_network.reset(self.episode)
+            return
         self.traffic_network.reset(self.episode)
         for _ in range(random.randint(5, self.heatup)):
             self.traffic_network.dump()
             traci.simulationStep()
+            self.traffic_network.observe()
+        if self.snapshots is not None:
+            self.snapshots.save()
 
     def close(self):
         self.traffic_network.close()
-        traci.close()
+        if self.args.reset_mode == 'restart':
+            self.disconnect()
 
     def step(self):
         self.traffic_network.step()
         self.traffic_network.dump()
         traci.simulationStep()
+        self.traffic_network.observe()
 
     def learn(self):
         if self.args.learn:
             self.traffic_network.learn()
 
-    def run(self):
-        for self.episode in range(self.args.episodes):
+    def run(self, on_episode_end=None):
+        """
+        :param on_episode_end: called with (episode, mean episode reward) after every episode, returns True to stop the run
+        """
+        for self.episode in range(self.start_episode, self.args.episodes):
             self.reset()
             self.steps = 0
             pbar = tqdm(total=self.args.max_steps)
+            if self.args.scheduler:
+                self.traffic_network.start_schedule()
+            end_time = self.traffic_network.observation.time + self.args.max_steps
+            # Wall time and simulated steps of regular and fast forwarded stepping
+            busy_time, busy_steps, idle_time, idle_steps = 0, 0, 0, 0
             while self.steps < self.args.max_steps:
-                self.step()
-                self.learn()
-                self.steps += 1
-                pbar.update(1)
+                start = time.time()
+                if self.args.idle_stride > 0 and self.traffic_network.is_idle():
+                    elapsed = self.traffic_network.fast_forward(end_time, self.args.idle_stride)
+                    if self.args.scheduler:
+                        self.traffic_network.start_schedule()
+                    idle_time += time.time() - start
+                    idle_steps += elapsed
+                else:
+                    if self.args.scheduler:
+                        elapsed = self.traffic_network.advance(end_time, self.args.learn)
+                    else:
+                        self.step()
+                        self.learn()
+                        elapsed = 1
+                    busy_time += time.time() - start
+                    busy_steps += elapsed
+                self.steps += elapsed
+                pbar.update(elapsed)
+                if self.traffic_network.learner is not None and self.steps % 1000 < elapsed:
+                    pbar.set_postfix(self.traffic_network.learner.metrics())
+            if idle_steps > 0 and busy_steps > 0:
+                saved = idle_steps * busy_time / busy_steps - idle_time
+                tqdm.write("Episode " + str(self.episode) + ": fast forwarded " + str(idle_steps) +
+                           " idle steps, saved ~" + str(round(saved, 1)) + " seconds")
+            if self.traffic_network.learner is not None:
+                tqdm.write("Episode " + str(self.episode) + " learner: " + str(self.traffic_network.learner.metrics()))
             self.close()
             pbar.close()
+            if self.checkpoints is not None and (self.episode + 1) % self.args.checkpoint_interval == 0:
+                self.checkpoints.save(self.episode, *self.traffic_network.training_state())
+            if on_episode_end is not None and on_episode_end(self.episode, self.traffic_network.episode_reward()):
+                break
+        self.traffic_network.shutdown()
+        if self.checkpoints is not None:
+            self.checkpoints.close()
+        self.disconnect()
@@ -0,0 +1,272 @@
+"""
+Vectorized surrogate of the SUMO simulation, to pretrain the junction agents at a much higher throughput.
+The network is read from the .net.xml with sumolib, no SUMO process is started, and num_envs copies of it
+are simulated at once with a fluid queue model:
+- every controlled lane holds a queue of vehicles, served at the saturation flow while its links are green,
+- the vehicles served join the controlled lanes of the next traffic light on their way, if any,
+- the lanes not fed by another traffic light get Poisson arrivals following TrafficGenerator.time_probability.
+The traffic lights follow the phase logic of Junction (yellow, sim_step, min_green_duration) and the states and
+rewards have the layout of Junction.generate_state and Junction.calculate_reward, so the weights saved here
+are loaded by DeepRLight.py --pretrained and fine tuned in SUMO.
+Persons are not simulated, the waiting persons part of the state is always 0.
+"""
+import argparse
+import os
+import random
+import time
+import numpy as np
+import torch
+from sumolib import net
+from tqdm import trange
+from Agent import DQN_Agent, Double_DQN_Agent
+from Utils.AgentParams import AgentParams
+from Utils.ArgParser import process_arguments
+from Utils.Topology import allowed, net_file
+from Utils.TrafficGenerator import TrafficGenerator
+
+# Vehicles per second of a lane with all its links green
+SATURATION_FLOW = 0.5
+# Length of a queued vehicle including the gap, meters
+VEHICLE_SPACE = 7.5
+
+
+def is_walking(lane):
+    """ Same split as Junction """
+    return 'pedestrian' in allowed(lane)
+
+
+class SurrogateJunction:
+    '''
+    Traffic light of the num_envs copies of the network, every array has one row per copy.
+    '''
+    def __init__(self, tls, lanes_index, params, num_envs):
+        self.jid = tls.getID()
+        connections = tls.getConnections()
+        self.lanes = sorted(set(connection[0].getID() for connection in connections if not is_walking(connection[0])))
+        self.edges = sorted(set(connection[0].getEdge().getID() for connection in connections))
+        self.phases = [phase.state for phase in list(tls.getPrograms().values())[0].getPhases()]
+        self.params = params
+        self.num_envs = num_envs
+        # Columns of the lanes in the arrays of SurrogateNetwork
+        self.columns = np.array([lanes_index[lid] for lid in self.lanes])
+        # Fraction of the links of every lane which are green, per phase
+        links = np.zeros(len(self.lanes))
+        self.green = np.zeros((len(self.phases), len(self.lanes)))
+        for in_lane, out_lane, link in connections:
+            if in_lane.getID() not in lanes_index:
+                continue
+            lane = self.lanes.index(in_lane.getID())
+            links[lane] += 1
+            for i, state in enumerate(self.phases):
+                self.green[i, lane] += state[link] in 'Gg'
+        self.green /= np.maximum(links, 1)
+        self.input_size = len(self.edges) + len(self.lanes) + len(self.phases)
+        self.num_actions = len(self.phases)
+        self.reset()
+
+    def reset(self):
+        self.phase = np.zeros(self.num_envs, dtype=np.int64)
+        self.next_phase = np.zeros(self.num_envs, dtype=np.int64)
+        self.yellow_steps = np.zeros(self.num_envs, dtype=np.int64)
+        self.steps_counter = np.zeros(self.num_envs, dtype=np.int64)
+        self.last_state = np.zeros((self.num_envs, self.input_size), dtype=np.float32)
+        self.has_state = np.zeros(self.num_envs, dtype=bool)
+
+    def served(self):
+        """ Returns the green fraction of every lane, links stay green during yellow only if green in both phases """
+        green = self.green[self.phase]
+        yellow = self.yellow_steps > 0
+        green[yellow] = np.minimum(green[yellow], self.green[self.next_phase[yellow]])
+        return green
+
+    def step(self):
+        '''
+        Advance the traffic light of every copy by one second, as Junction.step.
+        :return: mask of the copies recording a transition, mask of the copies where the agent selects an action
+        '''
+        yellow = self.yellow_steps > 0
+        self.yellow_steps[yellow] -= 1
+        ended = yellow & (self.yellow_steps == 0)
+        self.phase[ended] = self.next_phase[ended]
+        self.steps_counter[ended] = 0
+        self.steps_counter[~yellow] += 1
+        ready = ~yellow & (self.steps_counter >= self.params.sim_step)
+        decide = ready & (self.steps_counter >= self.params.min_green_duration)
+        record = decide | (ready & (self.steps_counter % self.params.sim_step == 0))
+        return record, decide
+
+    def act(self, rows, actions):
+        change = actions != self.phase[rows]
+        self.next_phase[rows[change]] = actions[change]
+        self.yellow_steps[rows[change]] = self.params.yellow_duration
+        self.steps_counter[rows[~change]] = 0
+
+    def generate_state(self, mean_speed):
+        """ state = [num persons per edge] + [vehicle mean speed per lane] + [phases] """
+        return np.concatenate((np.zeros((self.num_envs, len(self.edges))),
+                               mean_speed[:, self.columns],
+                               np.eye(len(self.phases))[self.phase]), axis=1).astype(np.float32)
+
+    def calculate_reward(self, waiting_time):
+        # max waiting time
+        return -1 * waiting_time[:, self.columns].max(1)
+
+
+class SurrogateNetwork:
+    '''
+    num_envs copies of the network stepped together, the queues are arrays of shape (num_envs, lanes).
+    '''
+    def __init__(self, cfg, num_envs, agent_params=None, demand=30, seed=None, max_depth=5):
+        self.network = net.readNet(net_file(cfg), withPrograms=True)
+        self.num_envs = num_envs
+        self.demand = demand
+        self.rng = np.random.default_rng(seed)
+        self.generator = TrafficGenerator(None)
+        tls_list = sorted(self.network.getTrafficLights(), key=lambda tls: tls.getID())
+        self.lanes = sorted(set(connection[0].getID() for tls in tls_list for connection in tls.getConnections()
+                                if not is_walking(connection[0])))
+        lanes_index = dict((lid, i) for i, lid in enumerate(self.lanes))
+        self.junctions = [SurrogateJunction(tls, lanes_index,
+                                            AgentParams(os.path.dirname(cfg) + "/parameters/" + tls.getID() + ".ini", agent_params),
+                                            num_envs)
+                          for tls in tls_list]
+        lanes = [self.network.getLane(lid) for lid in self.lanes]
+        self.speed = np.array([lane.getSpeed() for lane in lanes])
+        self.capacity = np.array([max(lane.getLength() / VEHICLE_SPACE, 1) for lane in lanes])
+        # routes[i, j] fraction of the vehicles served on lane i which join the queue of lane j
+        self.routes = np.zeros((len(self.lanes), len(self.lanes)))
+        for tls in tls_list:
+            outgoing = dict()
+            for in_lane, out_lane, link in tls.getConnections():
+                if in_lane.getID() in lanes_index:
+                    outgoing.setdefault(lanes_index[in_lane.getID()], list()).append(out_lane.getEdge())
+            for lane, edges in outgoing.items():
+                for edge in edges:
+                    for target, fraction in self.downstream(edge, lanes_index, max_depth).items():
+                        self.routes[lane, target] += fraction / len(edges)
+        self.external = (self.routes.sum(0) == 0).astype(np.float64)
+        self.reset()
+
+    def downstream(self, edge, lanes_index, depth):
+        """ Returns {lane column: fraction} of the controlled lanes reached from edge, splitting evenly at every node """
+        lanes = [lanes_index[lane.getID()] for lane in edge.getLanes() if lane.getID() in lanes_index]
+        if len(lanes) > 0:
+            return dict((lane, 1 / len(lanes)) for lane in lanes)
+        targets = dict()
+        next_edges = [next_edge for next_edge in edge.getOutgoing() if next_edge.getFunction() != 'walkingarea']
+        if depth == 0 or len(next_edges) == 0:
+            return targets
+        for next_edge in next_edges:
+            for lane, fraction in self.downstream(next_edge, lanes_index, depth - 1).items():
+                targets[lane] = targets.get(lane, 0) + fraction / len(next_edges)
+        return targets
+
+    def reset(self):
+        self.time = 0
+        shape = (self.num_envs, len(self.lanes))
+        self.queue = np.zeros(shape)
+        # Waiting time of the vehicle at the head of every queue
+        self.waiting_time = np.zeros(shape)
+        # Every copy draws its own demand profile, vehicles per hour per unit of demand
+        self.profile = np.array([[self.generator.time_probability(hour) for hour in range(24)]
+                                 for _ in range(self.num_envs)], dtype=np.float64)
+        for junction in self.junctions:
+            junction.reset()
+
+    def mean_speed(self):
+        """ Free speed of the lane slowed down by its occupancy """
+        return self.speed * (1 - np.minimum(self.queue / self.capacity, 1))
+
+    def step(self):
+        '''
+        Advance all the copies by one second.
+        :return: list of (record, decide) masks of the junctions, see SurrogateJunction.step
+        '''
+        rate = self.demand * self.profile[:, (self.time // 3600) % 24] / 3600
+        arrivals = self.rng.poisson(rate[:, None] * self.external[None, :])
+        served = np.zeros_like(self.queue)
+        for junction in self.junctions:
+            served[:, junction.columns] = junction.served()
+        departures = np.minimum(self.queue, SATURATION_FLOW * served)
+        remaining = self.queue - departures
+        # First in first out, the head of the remaining queue arrived later
+        self.waiting_time *= remaining / np.maximum(self.queue, 1e-9)
+        self.queue = remaining + arrivals + departures @ self.routes
+        waiting = self.queue > 1e-3
+        self.waiting_time[waiting] += 1
+        self.waiting_time[~waiting] = 0
+        self.time += 1
+        return [junction.step() for junction in self.junctions]
+
+
+def select_batch(agent, states):
+    '''
+    Epsilon greedy actions of one agent for a batch of states, the greedy rows are evaluated in one forward pass.
+    '''
+    actions = np.random.randint(agent.n_actions, size=len(states))
+    greedy = np.array([not agent.explore() for _ in range(len(states))], dtype=bool)
+    if greedy.any():
+        with torch.no_grad():
+            q_values = agent.acting_net(torch.from_numpy(states[greedy]).float().to(agent.device))
+        actions[greedy] = q_values.argmax(1).cpu().numpy()
+    return actions
+
+
+def pretrain(args, num_envs, demand, output):
+    surrogate = SurrogateNetwork(args.cfg, num_envs, args.agent_params, demand=demand, seed=args.seed)
+    agent_class = Double_DQN_Agent if args.agent == 'double_dqn' else DQN_Agent
+    for junction in surrogate.junctions:
+        if junction.params.replay_path is None:
+            junction.params.replay_path = os.path.join(output, junction.jid, "replay", "memory.replay")
+    agents = dict((junction.jid, agent_class(junction.input_size, junction.num_actions, junction.params))
+                  for junction in surrogate.junctions)
+    start = time.time()
+    for episode in range(args.episodes):
+        surrogate.reset()
+        rewards = dict((junction.jid, list()) for junction in surrogate.junctions)
+        for _ in trange(args.max_steps):
+            masks = surrogate.step()
+            mean_speed = surrogate.mean_speed()
+            for junction, (record, decide) in zip(surrogate.junctions, masks):
+                if not record.any():
+                    continue
+                agent = agents[junction.jid]
+                state = junction.generate_state(mean_speed)
+                reward = junction.calculate_reward(surrogate.waiting_time)
+                for row in np.flatnonzero(record & junction.has_state):
+                    agent.add_to_memory(junction.last_state[row], junction.phase[row], state[row], reward[row])
+                rewards[junction.jid].extend(reward[record])
+                rows = np.flatnonzero(decide)
+                if len(rows) > 0:
+                    junction.last_state[rows] = state[rows]
+                    junction.has_state[rows] = True
+                    junction.act(rows, select_batch(agent, state[rows]))
+                    agent.optimize_model()
+        print("Episode " + str(episode) + ": " + str(dict((jid, round(float(np.mean(r)), 2)) for jid, r in rewards.items())) +
+              ", " + str(round(num_envs * surrogate.time * (episode + 1) / (time.time() - start))) + " simulated seconds/s")
+    for jid, agent in agents.items():
+        os.makedirs(os.path.join(output, jid), exist_ok=True)
+        agent.save_ckpt(os.path.join(output, jid))
+    return agents
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="DeepRLight surrogate pretraining, the other arguments are the DeepRLight ones")
+    parser.add_argument("-ne", "--envs", type=int, default=64, dest="envs",
+                        help='Number of copies of the network simulated at once')
+    parser.add_argument("-de", "--demand", type=float, default=30, dest="demand",
+                        help='Vehicles per hour of every entry lane per unit of TrafficGenerator.time_probability')
+    parser.add_argument("-o", "--output", type=str, default=None, dest="output",
+                        help='Weights directory, default: Networks/<network>/pretrained')
+    surrogate_args, argv = parser.parse_known_args()
+    args = process_arguments(argv)
+    if args.agent not in ('dqn', 'double_dqn'):
+        parser.error("pretraining needs a dqn or double_dqn agent, use -ag")
+    if args.seed is not None:
+        random.seed(args.seed)
+        np.random.seed(args.seed)
+        torch.manual_seed(args.seed)
+    output = surrogate_args.output
+    if output is None:
+        output = os.path.join(args.network, 'pretrained')
+    pretrain(args, surrogate_args.envs, surrogate_args.demand, output)
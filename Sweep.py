@@ -0,0 +1,115 @@
+"""
+Hyperparameter sweep over the parameters/*.ini values.
+The spec is a json file:
+{
+    "search": "grid" or "random",
+    "trials": number of random trials (random search only),
+    "seed": base seed, trial i runs with seed + i,
+    "argv": ["-n", "double", "-e", "20", "-s", "3000", "-ag", "double_dqn"],
+    "params": {"eps_decay": [100, 500, 1000], "discount": [0.99, 0.999], "layers": ["128,64,16", "64,32"]},
+    "grace_episodes": number of episodes before a trial can be stopped early
+}
+Every trial overrides the .ini values of all the junctions with one combination of params.
+Early stopping is the median stopping rule: after grace_episodes, a trial whose mean reward at an episode is
+below the median of the other trials at the same episode is stopped.
+"""
+import argparse
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from Utils.ArgParser import process_arguments
+
+
+def expand_trials(spec):
+    """ Returns the list of params dicts of the trials """
+    keys = sorted(spec['params'].keys())
+    if spec.get('search', 'grid') == 'grid':
+        return [dict(zip(keys, values)) for values in itertools.product(*[spec['params'][key] for key in keys])]
+    rand = random.Random(spec.get('seed', 0))
+    return [dict((key, rand.choice(spec['params'][key])) for key in keys) for _ in range(spec['trials'])]
+
+
+class MedianStopping:
+    '''
+    Median stopping rule over the per episode mean rewards shared by all the trials.
+    '''
+    def __init__(self, rewards, trial, grace_episodes):
+        self.rewards = rewards
+        self.trial = trial
+        self.grace_episodes = grace_episodes
+        self.stopped = False
+
+    def __call__(self, episode, reward):
+        self.rewards[self.trial] = self.rewards.get(self.trial, []) + [float(reward)]
+        if episode + 1 < self.grace_episodes:
+            return False
+        others = [rewards[episode] for trial, rewards in self.rewards.items() if trial != self.trial and len(rewards) > episode]
+        self.stopped = len(others) > 0 and reward < np.median(others)
+        return self.stopped
+
+
+def run_trial(trial, params, argv, seed, root, rewards, grace_episodes):
+    from Simularor import Simulator
+    args = process_arguments(argv)
+    args.agent_params.update(params)
+    args.seed = seed
+    args.label = "DeepRLight_trial_" + str(trial)
+    args.log_root = os.path.join(root, "trial_" + str(trial))
+    args.animation = False
+    start = time.time()
+    stopping = MedianStopping(rewards, trial, grace_episodes)
+    Simulator(args).run(on_episode_end=stopping)
+    episode_rewards = rewards.get(trial, [])
+    return {'trial': trial, 'seed': seed, 'episodes': len(episode_rewards),
+            'final_reward': episode_rewards[-1] if len(episode_rewards) > 0 else None,
+            'best_reward': max(episode_rewards) if len(episode_rewards) > 0 else None,
+            'stopped_early': stopping.stopped, 'wall_time': round(time.time() - start, 1)}
+
+
+def write_summary(path, trials, results):
+    keys = sorted(trials[0].keys())
+    with open(path, "w", newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['trial'] + keys + ['seed', 'episodes', 'final_reward', 'best_reward', 'stopped_early', 'wall_time'])
+        for result in sorted(results, key=lambda r: r['trial']):
+            writer.writerow([result['trial']] + [trials[result['trial']][key] for key in keys] +
+                            [result['seed'], result['episodes'], result['final_reward'], result['best_reward'],
+                             result['stopped_early'], result['wall_time']])
+
+
+def sweep(spec, workers, root):
+    trials = expand_trials(spec)
+    os.makedirs(root, exist_ok=True)
+    context = multiprocessing.get_context('spawn')
+    manager = context.Manager()
+    rewards = manager.dict()
+    seed = spec.get('seed', 0)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        futures = [pool.submit(run_trial, i, params, spec.get('argv', []), seed + i, root, rewards,
+                               spec.get('grace_episodes', 3))
+                   for i, params in enumerate(trials)]
+        results = [future.result() for future in futures]
+    write_summary(os.path.join(root, "summary.csv"), trials, results)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="DeepRLight hyperparameters sweep")
+    parser.add_argument("spec", type=str, help='json sweep spec')
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(), dest="workers")
+    parser.add_argument("-o", "--output", type=str, default=None, dest="output",
+                        help='Sweep directory, default: sweeps/<timestamp>')
+    sweep_args = parser.parse_args()
+    with open(sweep_args.spec) as f:
+        sweep_spec = json.load(f)
+    output = sweep_args.output
+    if output is None:
+        output = os.path.join("sweeps", time.strftime('%Y_%m_%d__%H_%M_%S', time.localtime()))
+    for row in sweep(sweep_spec, sweep_args.workers, output):
+        print(row)
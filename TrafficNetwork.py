@@ -1,148 +1,222 @@
+import contextlib
 import os
-import traci
+import sys
+from Utils.Backend import backend as traci
+import traci.constants as tc
 from Utils.AgentParams import AgentParams
-from Agent import Double_DQN_Agent, Cyclic_Agent
+from Agent import DQN_Agent, Double_DQN_Agent, Cyclic_Agent, Random_Agent, Greedy_Agent, Shared_Double_DQN_Agent, Shared_Agent_View, select_actions
 import numpy as np
 from Utils.Logging import Logging, LoggingCsv, GUIScreenShot
-from Utils.PlotAnimation import PlotAnimation, animation_process
+from Utils.PlotAnimation import PlotBuffer, animation_process
+from Utils.Observation import Observation, stage_type
+from Utils.VehicleRegistry import VehicleRegistry
+from Utils.Topology import Topology
+from Utils.MetricsWriter import MetricsWriter
+from Utils.MetricsStore import MetricsStore
+from Utils.AsyncLearner import AsyncLearner
 import time
+import heapq
 import matplotlib;
 import multiprocessing
 matplotlib.use("TkAgg")
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
-from multiprocessing import Process, Queue
+from multiprocessing import Process
+
+
+class LaneStatistics:
+    """ All the metrics of a lane for one simulation step, computed in a single pass over its vehicles """
+    classes = ['passenger', 'bus', 'emergency']
+
+    def __init__(self, lane, previous_cars):
+        self.step = lane.observation.steps
+        self.cars = set(lane.vehicles())
+        counts = dict((vclass, 0) for vclass in LaneStatistics.classes)
+        speeds = dict((vclass, 0.0) for vclass in LaneStatistics.classes)
+        self.max_waiting_time = float(0)
+        self.total_waiting_time = float(0)
+        for vid in self.cars:
+            vehicle = lane.observation.vehicle(vid)
+            waiting_time = vehicle[tc.VAR_ACCUMULATED_WAITING_TIME]
+            self.max_waiting_time = max(self.max_waiting_time, waiting_time)
+            self.total_waiting_time += waiting_time
+            vclass = lane.registry.get_class(vid)
+            if vclass in counts:
+                counts[vclass] += 1
+                speeds[vclass] += vehicle[tc.VAR_SPEED]
+        self.num_cars = counts['passenger']
+        self.num_buses = counts['bus']
+        self.num_emergency = counts['emergency']
+        self.passenger_mean_speed = speeds['passenger'] / counts['passenger'] if counts['passenger'] > 0 else 0
+        self.bus_mean_speed = speeds['bus'] / counts['bus'] if counts['bus'] > 0 else 0
+        self.emergency_mean_speed = speeds['emergency'] / counts['emergency'] if counts['emergency'] > 0 else 0
+        self.departed_number = len(self.cars - previous_cars)
+        self.mean_speed = lane.observation.lane(lane.lid, tc.LAST_STEP_MEAN_SPEED)
+        self.occupancy = lane.observation.lane(lane.lid, tc.LAST_STEP_OCCUPANCY)
+        self.halting_number = lane.observation.lane(lane.lid, tc.LAST_STEP_VEHICLE_HALTING_NUMBER)
 
 
 class Lane:
-    def __init__(self, lid):
+    def __init__(self, lid, observation, registry, topology):
         self.lid = lid
-        self.length = traci.lane.getLength(lid)
-        self.shape = traci.lane.getShape(lid)
-        self.eid = traci.lane.getEdgeID(lid)
-        self.width = traci.lane.getWidth(lid)
-        self.cars = list()
+        self.observation = observation
+        self.registry = registry
+        lane = topology.lane(lid)
+        self.length = lane['length']
+        self.shape = tuple(tuple(point) for point in lane['shape'])
+        self.eid = lane['edge']
+        self.width = lane['width']
+        self.cars = set()
+        self.stats = None
 
     def __repr__(self):
         string = "  - Lane id: " + self.lid + ", length: " + str(self.length) + ", Edge: " + self.eid + "\n"
         return string
 
+    def subscribe(self):
+        self.observation.subscribe_lane(self.lid)
+
+    def vehicles(self):
+        """ Returns the ids of the vehicles on this lane within the last simulation step """
+        return self.observation.lane_vehicle_ids(self.lid)
+
+    def statistics(self):
+        """ Returns the statistics of the last simulation step, computed at most once per step """
+        if self.stats is None or self.stats.step != self.observation.steps:
+            self.stats = LaneStatistics(self, self.cars)
+            self.cars = self.stats.cars
+        return self.stats
+
     def mean_speed(self):
         """ Returns the mean speed of vehicles that were on this lane within the last simulation step [m/s] """
-        return traci.lane.getLastStepMeanSpeed(self.lid)
+        return self.statistics().mean_speed
 
     def passenger_mean_speed(self):
-        veh = [vid for vid in traci.lane.getLastStepVehicleIDs(self.lid) if traci.vehicle.getVehicleClass(vid)=='passenger']
-        if len(veh)==0:
-            return 0
-        return np.mean([traci.vehicle.getSpeed(vid) for vid in veh])
+        return self.statistics().passenger_mean_speed
 
     def bus_mean_speed(self):
-        veh = [vid for vid in traci.lane.getLastStepVehicleIDs(self.lid) if
-               traci.vehicle.getVehicleClass(vid) == 'bus']
-        if len(veh) == 0:
-            return 0
-        return np.mean([traci.vehicle.getSpeed(vid) for vid in veh])
+        return self.statistics().bus_mean_speed
 
     def emergency_mean_speed(self):
-        veh = [vid for vid in traci.lane.getLastStepVehicleIDs(self.lid) if
-               traci.vehicle.getVehicleClass(vid) == 'emergency']
-        if len(veh) == 0:
-            return 0
-        return np.mean([traci.vehicle.getSpeed(vid) for vid in veh])
+        return self.statistics().emergency_mean_speed
 
     def max_waiting_time(self):
         """Returns the max waiting time for all vehicles on the lane [s]"""
-        return max([float(0)] + [traci.vehicle.getAccumulatedWaitingTime(car_id) for car_id in traci.lane.getLastStepVehicleIDs(self.lid)])
+        return self.statistics().max_waiting_time
+
+    def total_waiting_time(self):
+        """Returns the sum of the waiting times of all vehicles on the lane [s]"""
+        return self.statistics().total_waiting_time
+
+    def num_vehicles(self):
+        """The number of vehicles of any class on this lane within the last time step."""
+        return len(self.statistics().cars)
 
     def num_cars(self):
         """The number of passenger vehicles on this lane within the last time step."""
-        return len([vid for vid in traci.lane.getLastStepVehicleIDs(self.lid) if traci.vehicle.getVehicleClass(vid)=='passenger'])
+        return self.statistics().num_cars
 
     def num_buses(self):
         """The number of bus vehicles on this lane within the last time step."""
-        return len([vid for vid in traci.lane.getLastStepVehicleIDs(self.lid) if
-                    traci.vehicle.getVehicleClass(vid) == 'bus'])
+        return self.statistics().num_buses
 
     def num_emergency(self):
         """The number of emergency vehicles on this lane within the last time step."""
-        return len([vid for vid in traci.lane.getLastStepVehicleIDs(self.lid) if
-                    traci.vehicle.getVehicleClass(vid) == 'emergency'])
+        return self.statistics().num_emergency
 
     def occupancy(self):
         """Returns the total lengths of vehicles on this lane during the last simulation step divided by the length of this lane"""
-        return traci.lane.getLastStepOccupancy(self.lid)
+        return self.statistics().occupancy
 
     def halting_number(self):
         """Returns the total number of halting vehicles for the last time step on the given lane. A speed of less than 0.1 m/s is considered a halt."""
-        return traci.lane.getLastStepHaltingNumber(self.lid)
+        return self.statistics().halting_number
 
     def departed_number(self):
-        """Returns a list of ids of vehicles which departed (were inserted into the road network) in this time step."""
-        current_cars = traci.lane.getLastStepVehicleIDs(self.lid)
-        new_cars = [car for car in current_cars if car not in self.cars]
-        self.cars = current_cars
-        return len(new_cars)
+        """Returns the number of vehicles which entered this lane in this time step."""
+        return self.statistics().departed_number
 
     def get_edge_id(self):
         return self.eid
 
 class Edge:
-    def __init__(self, eid):
+    def __init__(self, eid, observation, topology):
         self.eid = eid
-        self.num_lanes = traci.edge.getLaneNumber(eid)
+        self.observation = observation
+        self.num_lanes = topology.edge(eid)['lanes']
 
     def __repr__(self):
         string = "  - Edge id: " + self.eid + ", number of lanes: " + str(self.num_lanes) + "\n"
         return string
 
+    def subscribe(self):
+        self.observation.subscribe_edge(self.eid)
+
     def get_persons(self):
-        return traci.edge.getLastStepPersonIDs(self.eid)
+        return self.observation.edge_person_ids(self.eid)
+
+    def is_waiting(self, person):
+        return stage_type(self.observation.person(person)[tc.VAR_STAGE]) == 1
 
     def get_waiting_persons(self):
-        return [person for person in self.get_persons() if traci.person.getStage(person)==1]
+        return [person for person in self.get_persons() if self.is_waiting(person)]
 
     def get_num_waiting_persons(self):
         return len(self.get_waiting_persons())
 
     def get_total_waiting_persons_time(self):
-        return sum([traci.person.getWaitingTime(person) for person in self.get_persons() if traci.person.getStage(person)==1])
+        return sum([self.observation.person(person)[tc.VAR_WAITING_TIME] for person in self.get_waiting_persons()])
 
 
 class Junction:
-    keys = ['sim_time', 'phase', 'reward', 'cars', 'buses', 'mean_speed', 'passenger_mean_speed', 'bus_mean_speed', 'emergency_mean_speed', 'max_wt', 'occupancy', 'persons', 'waiting_persons']
-    def __init__(self, jid, args, network_log_root, screenshots_logger):
+    # Statistics columns, span is the number of seconds a row covers, the phase dtype is set per junction
+    columns = [('sim_time', np.int32), ('span', np.int32), ('phase', None), ('reward', np.float32), ('cars', np.int32),
+               ('buses', np.int32), ('mean_speed', np.float32), ('passenger_mean_speed', np.float32),
+               ('bus_mean_speed', np.float32), ('emergency_mean_speed', np.float32), ('max_wt', np.float32),
+               ('occupancy', np.float32), ('persons', np.int32), ('waiting_persons', np.int32)]
+    keys = [name for name, _ in columns]
+    def __init__(self, jid, args, network_log_root, screenshots_logger, observation, registry, topology):
         self.jid = jid
-        self.lanes = [Lane(lid) for lid in set(traci.trafficlight.getControlledLanes(jid)) if 'pedestrian' not in traci.lane.getAllowed(lid)]
-        self.walking_lanes = [Lane(lid) for lid in set(traci.trafficlight.getControlledLanes(jid)) if 'pedestrian' in traci.lane.getAllowed(lid)]
-        self.edges = [Edge(eid) for eid in set([traci.lane.getEdgeID(lid) for lid in traci.trafficlight.getControlledLanes(jid)])]
-        self.phases = traci.trafficlight.getCompleteRedYellowGreenDefinition(jid)[0].getPhases()
-        self.default_program = traci.trafficlight.getProgram(jid)
+        self.observation = observation
+        lanes, walking_lanes, edges = Junction.layout(topology, jid)
+        self.lanes = [Lane(lid, observation, registry, topology) for lid in lanes]
+        self.walking_lanes = [Lane(lid, observation, registry, topology) for lid in walking_lanes]
+        self.edges = [Edge(eid, observation, topology) for eid in edges]
+        self.phases = topology.phases(jid)
+        self.default_program = topology.program(jid)
         self.state = None
         self.args = args
-        self.config_file = os.path.dirname(args.cfg) + "/parameters/" + self.jid + ".ini"
-        self.agentParams = AgentParams(self.config_file)
-        self.input_size = len(self.generate_state())
+        self.config_file = Junction.config_file_of(args, jid)
+        self.agentParams = AgentParams(self.config_file, args.agent_params)
+        if self.agentParams.replay_path is None:
+            self.agentParams.replay_path = Junction.replay_path(network_log_root, jid)
+        self.input_size = Junction.input_size_of(topology, jid)
         self.num_actions = len(self.phases)
-        self.agent = Cyclic_Agent(self.num_actions)
-        #self.agent = Double_DQN_Agent(self.input_size, self.num_actions, self.agentParams)
+        self.agent = self.create_agent()
         self.steps_counter = 0
         self.reward = None
         self.last_state = None
-        self.last_action = traci.trafficlight.getPhase(self.jid)
+        # Programs start on their first phase
+        self.last_action = 0
         self.network_log_root = network_log_root
         self.log_root = os.path.join(self.network_log_root, self.jid)
         self.logger = Logging(logfile=os.path.join(self.log_root, "prints"), name="Junction " + self.jid, stdout=True)
-        self.csv_logger = LoggingCsv(os.path.join(self.log_root, "statistics"), self.jid + "statistics", Junction.keys)
+        phase_width = max([len('idle')] + [len(phase.state) for phase in self.phases])
+        self.metrics = MetricsWriter(os.path.join(self.log_root, "statistics"),
+                                     [(name, 'U%d' % phase_width if name == 'phase' else dtype) for name, dtype in Junction.columns],
+                                     csv=args.metrics_csv)
         self.phase_logger = LoggingCsv(os.path.join(self.log_root, "phases"), self.jid + "phases", ['sim_time', 'phase'])
         self.screenshots_logger = screenshots_logger
         self.next_phase = None
-        self.current_phase_state = self.phases[traci.trafficlight.getPhase(self.jid)].state
+        self.current_phase_state = self.phases[self.last_action].state
         self.yellow_steps_counter = 0
+        self.last_step_time = 0
         self.episode = -1
         self.best_reward = -np.Inf
         self.episode_rewards = list()
+        # Episode aggregates, see episode_summary
+        self.reset_summary()
 
     def __repr__(self):
         string = "- Junction id: " + self.jid + "\n"
@@ -150,7 +224,76 @@ class Junction:
         string += str(self.edges)
         return string
 
+    def create_agent(self):
+        if self.args.shared_agent:
+            # Set by TrafficNetwork.create_shared_agent
+            return None
+        if self.args.agent in ('dqn', 'double_dqn'):
+            if self.args.agent == 'double_dqn':
+                agent = Double_DQN_Agent(self.input_size, self.num_actions, self.agentParams)
+            else:
+                agent = DQN_Agent(self.input_size, self.num_actions, self.agentParams)
+            if self.args.pretrained is not None:
+                if os.path.exists(os.path.join(self.pretrained_folder(), 'shared_policy_net.pth')):
+                    sys.exit(self.args.pretrained + " holds shared agent weights, evaluate them with -ag greedy")
+                agent.load_ckpt(self.pretrained_folder())
+            return agent
+        if self.args.agent == 'greedy':
+            agent = Greedy_Agent(self.input_size, self.num_actions, self.agentParams.layers)
+            agent.load_ckpt(self.pretrained_folder())
+            return agent
+        if self.args.agent == 'random':
+            return Random_Agent(self.num_actions)
+        return Cyclic_Agent(self.num_actions)
+
+    @staticmethod
+    def layout(topology, jid):
+        """ Returns the ids of the lanes, walking lanes and edges of a junction, in the order of its state """
+        controlled_lanes = sorted(set(topology.controlled_lanes(jid)))
+        # Sorted, the state layout must not change between runs (checkpoints, surrogate pretraining)
+        lanes = [lid for lid in controlled_lanes if 'pedestrian' not in topology.lane(lid)['allowed']]
+        walking_lanes = [lid for lid in controlled_lanes if 'pedestrian' in topology.lane(lid)['allowed']]
+        edges = sorted(set([topology.lane(lid)['edge'] for lid in controlled_lanes]))
+        return lanes, walking_lanes, edges
+
+    @staticmethod
+    def input_size_of(topology, jid):
+        """ Size of generate_state """
+        lanes, _, edges = Junction.layout(topology, jid)
+        return len(edges) + len(lanes) + len(topology.phases(jid))
+
+    @staticmethod
+    def config_file_of(args, jid):
+        return os.path.dirname(args.cfg) + "/parameters/" + jid + ".ini"
+
+    @staticmethod
+    def replay_path(network_log_root, jid):
+        """ Default memory mapped replay file, one per run and junction, reopened by --resume """
+        return os.path.join(network_log_root, jid, "replay", "memory.replay")
+
+    def pretrained_folder(self):
+        return Junction.pretrained_folder_of(self.args.pretrained, self.jid)
+
+    @staticmethod
+    def pretrained_folder_of(pretrained, jid):
+        """ <pretrained>/<jid>/checkpoint of the logs of a training run, or <pretrained>/<jid> of Surrogate.py """
+        folder = os.path.join(pretrained, jid)
+        if os.path.isdir(os.path.join(folder, "checkpoint")):
+            return os.path.join(folder, "checkpoint")
+        return folder
+
+    def subscribe(self):
+        """ Register the subscriptions of this junction, must be done for every new TraCI connection """
+        self.observation.subscribe_simulation()
+        self.observation.subscribe_tls(self.jid)
+        for lane in self.lanes:
+            lane.subscribe()
+        for edge in self.edges:
+            edge.subscribe()
+        self.observation.update()
+
     def reset(self, episode):
+        self.subscribe()
         if self.episode != -1:
             current_mean = np.mean(self.episode_rewards)
             if current_mean > self.best_reward:
@@ -159,13 +302,23 @@ class Junction:
                 self.agent.save_ckpt(os.path.join(self.log_root, "checkpoint"))
             self.logger.info_global("Episode " + str(self.episode) + " mean reward:" + str(current_mean))
             self.episode_rewards = list()
+            self.reset_summary()
         self.episode = episode
-        self.csv_logger.set_new_file("Episode_" + str(episode))
+        self.metrics.set_new_file("Episode_" + str(episode))
         self.phase_logger.set_new_file("Episode_" + str(episode))
-        self.phase_logger.log(time.strftime('%H:%M:%S', time.gmtime(traci.simulation.getTime())),
-                              self.phases[traci.trafficlight.getPhase(self.jid)].state)
+        self.phase_logger.log(time.strftime('%H:%M:%S', time.gmtime(self.observation.time)),
+                              self.phases[self.observation.phase(self.jid)].state)
         self.logger.set_new_file("Episode_" + str(episode))
-        self.last_phase = traci.trafficlight.getPhase(self.jid)
+        self.last_phase = self.observation.phase(self.jid)
+
+    def is_idle(self):
+        """ True when there are no vehicles on the controlled lanes and no waiting persons """
+        return all(len(lane.vehicles()) == 0 for lane in self.lanes) and \
+               all(edge.get_num_waiting_persons() == 0 for edge in self.edges)
+
+    def log_idle(self, start, end):
+        """ Log a fast forwarded idle span as a single row """
+        self.metrics.log(start, end - start, 'idle', 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
 
     def save_results(self, prev_state, prev_action, new_state, reward):
         if self.last_action is not None and prev_state is not None:
@@ -173,8 +326,8 @@ class Junction:
 
     def dump(self):
         result = dict()
-        result['sim_time'] = time.strftime('%H:%M:%S', time.gmtime(traci.simulation.getTime()))
-        result['time'] = int(traci.simulation.getTime())
+        result['sim_time'] = time.strftime('%H:%M:%S', time.gmtime(self.observation.time))
+        result['time'] = int(self.observation.time)
         result['cars'] = sum([lane.num_cars() for lane in self.lanes])
         result['buses'] = sum([lane.num_buses() for lane in self.lanes])
         result['departed'] = sum([lane.departed_number() for lane in self.lanes])
@@ -186,20 +339,20 @@ class Junction:
         result['max_wt'] = max([lane.max_waiting_time() for lane in self.lanes])
         result['halting_number'] = sum([lane.halting_number() for lane in self.lanes])
         result['occupancy'] = sum([lane.occupancy() for lane in self.lanes])
-        result['phase'] = self.phases[traci.trafficlight.getPhase(self.jid)].state
+        result['phase'] = self.current_phase_state
         result['reward'] = self.calculate_reward()
         result['persons'] = sum([len(edge.get_persons()) for edge in self.edges])
         result['waiting_persons'] = sum([len(edge.get_waiting_persons()) for edge in self.edges])
         if self.args.capture and (self.episode % self.args.episode_capture) == 0:
-            self.screenshots_logger.log(self.episode, result['reward'], result['cars'], result['mean_speed'], result['max_wt'])
-        self.csv_logger.log(result['sim_time'], result['phase'], result['reward'], result['cars'], result['buses'], result['mean_speed'], result['passenger_mean_speed'], result['bus_mean_speed'], result['emergency_mean_speed'], result['max_wt'], result['occupancy'], result['persons'], result['waiting_persons'])
+            self.screenshots_logger.log(self.episode, result['time'], result['reward'], result['cars'], result['mean_speed'], result['max_wt'])
+        self.metrics.log(result['time'], self.args.dump_interval, result['phase'], result['reward'], result['cars'], result['buses'], result['mean_speed'], result['passenger_mean_speed'], result['bus_mean_speed'], result['emergency_mean_speed'], result['max_wt'], result['occupancy'], result['persons'], result['waiting_persons'])
         return self.jid, result
 
     def set_yellow_phase(self, next_phase):
         current_phase_state = self.phases[self.last_action].state
         next_phase_state = self.phases[next_phase].state
         yellow_phase_state = ''.join(['y' if prev_light.lower()=='g' and new_light.lower()=='r' else prev_light for prev_light, new_light in zip(current_phase_state, next_phase_state)])
-        self.phase_logger.log(time.strftime('%H:%M:%S', time.gmtime(traci.simulation.getTime())),
+        self.phase_logger.log(time.strftime('%H:%M:%S', time.gmtime(self.observation.time)),
                               yellow_phase_state)
         traci.trafficlight.setRedYellowGreenState(self.jid, yellow_phase_state)
         self.current_phase_state = yellow_phase_state
@@ -208,8 +361,9 @@ class Junction:
 
     def set_phase(self, phase):
         if self.last_action != phase:
-            self.phase_logger.log(time.strftime('%H:%M:%S', time.gmtime(traci.simulation.getTime())),
+            self.phase_logger.log(time.strftime('%H:%M:%S', time.gmtime(self.observation.time)),
                               self.phases[phase].state)
+            self.phase_switches += 1
         traci.trafficlight.setProgram(self.jid, self.default_program)
         traci.trafficlight.setPhase(self.jid, phase)
         self.current_phase_state = self.phases[phase].state
@@ -218,11 +372,43 @@ class Junction:
 
     def generate_state(self):
         """ state = [num persons per edge] + [vehicle mean speed per lane] + [phases] """
-        phase_state = np.eye(len(self.phases))[traci.trafficlight.getPhase(self.jid)]
+        phase_state = np.eye(len(self.phases))[self.observation.phase(self.jid)]
         edges_persons_total_num_state = np.array([edge.get_num_waiting_persons() for edge in self.edges])
         lanes_mean_speed_state = np.array([lane.mean_speed() for lane in self.lanes])
         return np.concatenate((edges_persons_total_num_state , lanes_mean_speed_state, phase_state))
 
+    def reset_summary(self):
+        self.throughput = 0
+        self.phase_switches = 0
+        self.last_vehicles = set()
+        # Sampled at every agent step, so they do not depend on --dump
+        self.rewards_sum = float(0)
+        self.agent_steps = 0
+        self.waiting_time_sum = float(0)
+        self.waiting_vehicles = 0
+        self.max_wait = float(0)
+
+    def sample_summary(self, reward):
+        self.rewards_sum += reward
+        self.agent_steps += 1
+        self.waiting_time_sum += sum([lane.total_waiting_time() for lane in self.lanes])
+        self.waiting_vehicles += sum([lane.num_vehicles() for lane in self.lanes])
+        self.max_wait = max(self.max_wait, max([lane.max_waiting_time() for lane in self.lanes]))
+
+    def episode_summary(self):
+        """
+        Aggregates of the current episode, see Utils.MetricsStore
+        mean_wait is the mean accumulated waiting time of the vehicles on the controlled lanes over the agent steps,
+        max_wait the longest one.
+        """
+        if self.agent_steps == 0:
+            return {'throughput': self.throughput, 'phase_switches': self.phase_switches}
+        return {'mean_wait': self.waiting_time_sum / self.waiting_vehicles if self.waiting_vehicles > 0 else float(0),
+                'max_wait': self.max_wait,
+                'throughput': self.throughput,
+                'reward': self.rewards_sum / self.agent_steps,
+                'phase_switches': self.phase_switches}
+
     def calculate_reward(self):
         # max waiting time
         reward = -1*max([lane.max_waiting_time() for lane in self.lanes])
@@ -230,33 +416,58 @@ class Junction:
         return reward
         #return max(np.mean([lane.mean_speed() for lane in self.lanes]) * sum([lane.num_cars() for lane in self.lanes]), 0)
 
-    def step(self):
+    def next_step_in(self):
+        """ Returns the number of simulation steps until step() has work to do """
+        if self.current_phase_state.count('y') > 0:
+            return max(self.agentParams.yellow_duration - self.yellow_steps_counter, 1)
+        if self.steps_counter < self.agentParams.sim_step:
+            return self.agentParams.sim_step - self.steps_counter
+        if not self.args.sparse_transitions:
+            # A transition every step from sim_step until the decision at min_green_duration, as stepping every second
+            return 1
+        # A transition every sim_step steps until the decision at min_green_duration
+        next_agent_step = min((self.steps_counter // self.agentParams.sim_step + 1) * self.agentParams.sim_step,
+                              self.agentParams.min_green_duration)
+        return max(next_agent_step - self.steps_counter, 1)
+
+    def step(self, elapsed=1):
+        """
+        Advance the junction by elapsed simulation steps.
+        :return: True when the agent has to select an action for self.last_state, see act()
+        """
+        self.last_step_time = self.observation.time
         if self.current_phase_state.count('y') > 0:
             # Current phase is yellow
-            self.yellow_steps_counter += 1
+            self.yellow_steps_counter += elapsed
             if self.yellow_steps_counter >= self.agentParams.yellow_duration:
                 self.yellow_steps_counter = 0
                 # Time to change to next phase
                 self.set_phase(self.next_phase)
-                return
-            return
+                return False
+            return False
 
-        self.steps_counter += 1
+        self.steps_counter += elapsed
         # Do agent step once for sim_step simulator steps
         if self.steps_counter < self.agentParams.sim_step:
-            return
+            return False
 
         # Calculate reward for last previous action
         reward = self.calculate_reward()
+        self.sample_summary(reward)
+        # Vehicles which left the controlled lanes since the last agent step
+        vehicles = set().union(*[lane.vehicles() for lane in self.lanes])
+        self.throughput += len(self.last_vehicles - vehicles)
+        self.last_vehicles = vehicles
         new_state = self.generate_state()
         self.save_results(self.last_state, self.last_action, new_state, reward)
 
         if self.steps_counter < self.agentParams.min_green_duration:
-            return
+            return False
 
         self.last_state = new_state
-        action = self.agent.select_action(self.last_state)
+        return True
 
+    def act(self, action):
         if self.last_action != action:
             # Yellow phase required
             self.set_yellow_phase(action)
@@ -264,12 +475,16 @@ class Junction:
             self.set_phase(action)
 
     def close(self):
+        self.metrics.close()
         if self.args.capture:
             self.screenshots_logger.close()
 
-    def learn(self):
+    def needs_learning(self):
         # Learn after number of sim_step done
-        if self.steps_counter == 0:
+        return self.steps_counter == 0
+
+    def learn(self):
+        if self.needs_learning():
             self.agent.optimize_model()
 
 
@@ -278,50 +493,249 @@ class TrafficNetwork:
         self.args = args
         self.time = time.strftime('%Y_%m_%d__%H_%M_%S', time.localtime())
         self.network_log_root = os.path.join(os.path.join(args.network, 'logs'), self.time)
-        self.junctions = [Junction(jid, args, self.network_log_root, GUIScreenShot(os.path.join(self.network_log_root, "captures"), jid, views_dict[jid])) for jid in list(traci.trafficlight.getIDList())]
+        if args.log_root is not None:
+            self.network_log_root = args.log_root
+        self.observation = Observation()
+        self.registry = VehicleRegistry()
+        self.topology = Topology(args.cfg)
+        self.junctions = [Junction(jid, args, self.network_log_root, GUIScreenShot(os.path.join(self.network_log_root, "captures"), jid, views_dict[jid], args.frame_interval), self.observation, self.registry, self.topology) for jid in self.topology.tls_ids()]
         self.dump_data = dict()
+        # Event driven stepping, heap of (next step time, junction index)
+        self.schedule = list()
         self.seconds_update = 600
         self.seconds_counter = 0
         self.episode = 0
+        self.shared_agent = None
+        if args.shared_agent:
+            self.create_shared_agent()
+        self.learner = None
+        if args.async_learn:
+            self.create_learner()
+        self.store = None
+        if args.metrics_db:
+            self.create_store()
+        # Wall and simulation time of the start of the current episode
+        self.episode_start = None
+        self.episode_start_time = 0
         if args.animation:
             self.create_plot_animation()
 
-    def create_plot_animation(self):
-        self.communicator = Queue()
+    def create_shared_agent(self):
+        """ Replace the agents of all the junctions by views of one shared agent """
+        # Widest state + junction index column
+        state_size = max(junction.input_size for junction in self.junctions) + 1
+        junctions_actions = [junction.num_actions for junction in self.junctions]
+        # One set of hyperparameters for the whole network, the .ini files of the junctions must agree
+        params = dict(self.junctions[0].agentParams.config['params'])
+        for junction in self.junctions[1:]:
+            different = sorted(key for key in set(params) | set(junction.agentParams.config['params'])
+                               if params.get(key) != junction.agentParams.config['params'].get(key))
+            if len(different) > 0:
+                sys.exit("--shared-agent needs the same parameters for every junction, " + junction.config_file +
+                         " differs from " + self.junctions[0].config_file + " in " + ", ".join(different))
+        self.shared_agent = Shared_Double_DQN_Agent(state_size, max(junctions_actions), self.junctions[0].agentParams,
+                                                    junctions_actions)
+        for i, junction in enumerate(self.junctions):
+            junction.agent = Shared_Agent_View(self.shared_agent, i, junction.num_actions)
+
+    def learning_agents(self):
+        if self.shared_agent is not None:
+            return [self.shared_agent]
+        return [junction.agent for junction in self.junctions if isinstance(junction.agent, DQN_Agent)]
+
+    def checkpoint_agents(self):
+        """ {name: agent} of the agents whose training state is checkpointed """
+        if self.shared_agent is not None:
+            return {'shared': self.shared_agent}
+        return dict((junction.jid, junction.agent) for junction in self.junctions if isinstance(junction.agent, DQN_Agent))
+
+    def training_state(self):
+        '''
+        Copy of the training state of the network, see Utils.Checkpoint.
+        :return: network state, {name: (agent state, replay memory state)}
+        '''
+        network_state = {'best_rewards': dict((junction.jid, junction.best_reward) for junction in self.junctions)}
+        with self.learner.paused() if self.learner is not None else contextlib.nullcontext():
+            agents_states = dict((name, agent.training_state()) for name, agent in self.checkpoint_agents().items())
+        return network_state, agents_states
+
+    def load_training_state(self, network_state, agents_states):
         for junction in self.junctions:
-            jid, results = junction.dump()
-            self.dump_data[jid] = dict((k, results[k]) for k in ('time', 'cars', 'max_wt', 'mean_speed'))
-        self.plot_process = Process(target=animation_process, args=(self.dump_data, self.communicator)).start()
-        self.dump_list = dict()
+            junction.best_reward = network_state['best_rewards'].get(junction.jid, junction.best_reward)
+        for name, agent in self.checkpoint_agents().items():
+            if name in agents_states:
+                agent.load_training_state(*agents_states[name])
+
+    def create_store(self):
+        """ Register the run and its hyperparameters in the metrics store """
+        self.store = MetricsStore(self.args.metrics_db)
+        params = dict((junction.jid, dict(junction.agentParams.config.items('params'))) for junction in self.junctions)
+        params[''] = dict((key, value) for key, value in vars(self.args).items()
+                          if key in ('agent', 'shared_agent', 'async_learn', 'seed', 'max_steps', 'episodes', 'scheduler', 'pretrained'))
+        params[''].update(self.args.agent_params)
+        self.store.add_run(self.network_log_root, os.path.basename(self.args.network), self.args.agent,
+                           dict((key, value) for key, value in vars(self.args).items() if key != 'agent_params'), params)
+
+    def record_episode(self):
+        """ Write the aggregates of the current episode of every junction to the metrics store """
+        if self.store is None or self.episode_start is None:
+            return
+        aggregates = dict()
         for junction in self.junctions:
-            self.dump_list[junction.jid] = list()
+            aggregates[junction.jid] = junction.episode_summary()
+            aggregates[junction.jid]['steps'] = int(self.observation.time - self.episode_start_time)
+            aggregates[junction.jid]['wall_time'] = time.time() - self.episode_start
+        self.store.add_episodes(self.network_log_root, os.path.basename(self.args.network), self.episode, aggregates)
+        self.episode_start = None
+
+    def create_learner(self):
+        self.learner = AsyncLearner(self.learning_agents(), utd_ratio=self.args.utd_ratio,
+                                    publish_interval=self.args.publish_interval, queue_size=self.args.learn_queue)
+
+    def create_plot_animation(self):
+        # Room for a whole episode of dumps
+        self.plot_buffer = PlotBuffer([junction.jid for junction in self.junctions],
+                                      self.args.max_steps // self.args.dump_interval + 1)
+        self.plot_process = Process(target=animation_process, args=self.plot_buffer.attach_args())
+        self.plot_process.start()
 
     def close(self):
         #self.network_screen_logger.close()
         for juntion in self.junctions:
             juntion.close()
 
-    def step(self):
-        for junction in self.junctions:
-            junction.step()
+    def observe(self):
+        """ Take the snapshot of the last simulation step """
+        last_time = self.observation.time
+        self.observation.update()
+        self.registry.update(self.observation.departed, self.observation.arrived)
+        if self.observation.time - last_time > 1:
+            # Only the departures and arrivals of the last of the skipped steps were reported
+            self.registry.sync(traci.vehicle.getIDList())
+
+    def is_idle(self):
+        """ True when no vehicle is in the network and all the junctions are idle """
+        return len(self.registry) == 0 and all(junction.is_idle() for junction in self.junctions)
+
+    def fast_forward(self, end_time, stride):
+        """
+        Jump over an idle span in strides of stride simulation steps, junctions are not stepped.
+        SUMO loads the vehicles route-steps (200 by default) seconds ahead of their departure, so as long as
+        stride is not larger, a vehicle departing within the next stride is already expected: then the network
+        moves one step at a time and control returns at the step the vehicle appears.
+        :return: number of simulated steps
+        """
+        start = now = self.observation.time
+        while now < end_time and self.is_idle():
+            step = 1 if traci.simulation.getMinExpectedNumber() > 0 else stride
+            traci.simulationStep(min(now + step, end_time))
+            self.observe()
+            now = self.observation.time
+        if self.args.dump:
+            for junction in self.junctions:
+                junction.log_idle(start, now)
+        return int(now - start)
+
+    def start_schedule(self):
+        """ Schedule the first step of every junction, the step done at the current time counts as one simulation step """
+        self.schedule = list()
+        now = self.observation.time
+        for i, junction in enumerate(self.junctions):
+            junction.last_step_time = now - 1
+            heapq.heappush(self.schedule, (junction.last_step_time + junction.next_step_in(), i))
+
+    def advance(self, end_time, learn):
+        """
+        Event driven alternative to step() + dump() + simulationStep() + learn() on every simulation step.
+        Steps only the junctions that have work to do now, then moves SUMO straight to the earliest
+        junction step, dump sampling time (when dumping) or end_time.
+        :return: number of simulated steps
+        """
+        now = self.observation.time
+        due = list()
+        while len(self.schedule) > 0 and self.schedule[0][0] <= now:
+            due.append(heapq.heappop(self.schedule)[1])
+        self.act([self.junctions[i] for i in due if self.junctions[i].step(now - self.junctions[i].last_step_time)])
+        self.dump()
+        if learn:
+            self.learn([self.junctions[i] for i in due])
+        for i in due:
+            heapq.heappush(self.schedule, (now + self.junctions[i].next_step_in(), i))
+        target = min(self.schedule[0][0], end_time)
+        if self.args.dump:
+            # Captures and the animation are fed by dump() too
+            target = min(target, (now // self.args.dump_interval + 1) * self.args.dump_interval)
+        traci.simulationStep(target)
+        self.observe()
+        return int(self.observation.time - now)
+
+    def act(self, junctions):
+        """ Select the actions of all the deciding junctions in one batch """
+        if len(junctions) == 0:
+            return
+        actions = select_actions([junction.agent for junction in junctions], [junction.last_state for junction in junctions])
+        for junction, action in zip(junctions, actions):
+            junction.act(action)
 
-    def learn(self):
-        for junction in self.junctions:
+    def step(self):
+        self.act([junction for junction in self.junctions if junction.step()])
+
+    def learn(self, junctions=None):
+        junctions = self.junctions if junctions is None else junctions
+        if self.learner is not None:
+            # Updates run on the learner thread
+            if self.shared_agent is not None:
+                if any(junction.needs_learning() for junction in junctions):
+                    self.learner.request(self.shared_agent)
+                return
+            for junction in junctions:
+                if junction.needs_learning() and isinstance(junction.agent, DQN_Agent):
+                    self.learner.request(junction.agent)
+            return
+        for junction in junctions:
             junction.learn()
+        if self.shared_agent is not None and any(junction.needs_learning() for junction in junctions):
+            # One update of the shared agent per step, whatever the number of junctions that acted
+            self.shared_agent.optimize_model()
+
+    def episode_reward(self):
+        """ Mean reward of the current episode over all the junctions """
+        return np.mean([np.mean(junction.episode_rewards) for junction in self.junctions if len(junction.episode_rewards) > 0])
+
+    def shutdown(self):
+        """ End of the run """
+        if self.learner is not None:
+            self.learner.close()
+        self.record_episode()
+        if self.store is not None:
+            self.store.close()
+        if self.args.animation:
+            self.plot_buffer.close()
+        MetricsWriter.wait()
 
     def dump(self):
-        if self.args.dump:
+        if self.args.dump and int(self.observation.time) % self.args.dump_interval == 0:
             for junction in self.junctions:
                 jid, results = junction.dump()
                 self.dump_data[jid] = dict((k, results[k]) for k in ('time', 'cars', 'max_wt', 'mean_speed'))
             #self.network_screen_logger.log(self.episode)
             if self.args.animation:
-                self.communicator.put(self.dump_data)
+                self.plot_buffer.write(self.dump_data)
 
     def reset(self, episode):
+        self.record_episode()
         self.episode = episode
-        for junction in self.junctions:
-            junction.reset(episode)
+        self.episode_start = time.time()
+        if self.args.animation:
+            self.plot_buffer.clear()
+        self.registry.clear()
+        # Junction.reset saves the checkpoints of the best episodes
+        with self.learner.paused() if self.learner is not None else contextlib.nullcontext():
+            for junction in self.junctions:
+                junction.reset(episode)
+        self.episode_start_time = self.observation.time
+        # Vehicles already in the network (loaded state) were not reported as departed
+        self.registry.update(traci.vehicle.getIDList(), ())
 
     def __repr__(self):
         string = "Traffic Network: \n"
@@ -1,10 +1,10 @@
-
-
 import configparser
+import os
 
 class AgentParams:
-    def __init__(self, file):
+    def __init__(self, file, overrides=None):
         self.file = file
+        self.overrides = dict() if overrides is None else overrides
         self.eps_start = 0
         self.eps_end = 0
         self.discount = 0
@@ -20,6 +20,8 @@ class AgentParams:
 
     def parse_config(self):
         self.config.read(self.file)
+        for key, value in self.overrides.items():
+            self.config.set('params', key, str(value))
         self.eps_start = float(self.config.get('params','eps_start'))
         self.eps_end = float(self.config.get('params', 'eps_end'))
         self.discount = float(self.config.get('params', 'discount'))
@@ -33,6 +35,19 @@ class AgentParams:
         self.sim_step = int(self.config.get('params', 'sim_step'))
         self.yellow_duration = int(self.config.get('params', 'yellow_duration'))
         self.min_green_duration = int(self.config.get('params', 'min_green_duration'))
+        self.prioritized_replay = self.config.getboolean('params', 'prioritized_replay', fallback=False)
+        self.per_alpha = float(self.config.get('params', 'per_alpha', fallback=0.6))
+        self.per_beta = float(self.config.get('params', 'per_beta', fallback=0.4))
+        self.per_beta_increment = float(self.config.get('params', 'per_beta_increment', fallback=0.001))
+        # memory: in RAM, mmap: memory mapped file at replay_path, shared by every agent and process using the same path
+        self.replay_backend = self.config.get('params', 'replay_backend', fallback='memory')
+        # Relative to the network directory. When not set, None: the run creating the agent picks a file of its own,
+        # see Junction.replay_path, so a new run never samples the transitions of a previous one
+        self.replay_path = self.config.get('params', 'replay_path', fallback='')
+        if self.replay_path == '':
+            self.replay_path = None
+        else:
+            self.replay_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(self.file))), self.replay_path)
 
 
 
@@ -2,7 +2,7 @@
 import argparse
 import os
 
-def process_arguments():
+def process_arguments(argv=None):
     parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
                                      description="DeepRLight\n" \
                                                  "\tAlexey Tusov, tusovalexey[at]gmail.com\n" \
@@ -17,9 +17,67 @@ def process_arguments():
     parser.add_argument("-a", "--animation", type=bool, default=False, dest='animation')
     parser.add_argument("-c", "--capture", type=bool, default=False, dest="capture")
     parser.add_argument("-ec", "--episode-capture", type=int, default=5, dest="episode_capture")
+    parser.add_argument("-fi", "--frame-interval", type=int, default=1, dest="frame_interval",
+                        help='Capture a frame every frame_interval simulation seconds')
     parser.add_argument("-d", "--dump", type=bool, default=False, dest="dump")
+    parser.add_argument("-di", "--dump-interval", type=int, default=1, dest="dump_interval",
+                        help='Dump junctions statistics every dump_interval simulation steps')
+    parser.add_argument("-mc", "--metrics-csv", type=bool, default=False, dest="metrics_csv",
+                        help='Also export the statistics of every episode to csv')
+    parser.add_argument("-db", "--metrics-db", type=str, default=None, dest="metrics_db",
+                        help='SQLite store to record the episodes aggregates in (e.g. metrics.db), see Utils/MetricsStore.py, default: off')
     parser.add_argument("-l", "--learn", type=bool, default=True, dest="learn")
-    args = parser.parse_args()
+    parser.add_argument("-ag", "--agent", type=str, default="cyclic", choices=['cyclic', 'random', 'dqn', 'double_dqn', 'greedy'],
+                        dest="agent", help='Agent of every junction, greedy acts with the --pretrained weights without learning')
+    parser.add_argument("-pt", "--pretrained", type=str, default=None, dest="pretrained",
+                        help='Logs directory of a training run, or weights directory of Surrogate.py, to start the DQN agents from')
+    parser.add_argument("-sa", "--shared-agent", type=bool, default=False, dest="shared_agent",
+                        help='One Double DQN agent with junction embeddings shared by all the junctions')
+    parser.add_argument("-al", "--async-learn", type=bool, default=False, dest="async_learn",
+                        help='Run the agents updates on a background learner thread')
+    parser.add_argument("-utd", "--utd-ratio", type=int, default=1, dest="utd_ratio",
+                        help='Number of updates per learn request of the async learner')
+    parser.add_argument("-pi", "--publish-interval", type=int, default=10, dest="publish_interval",
+                        help='Number of async updates between copies of the policy weights to the acting net')
+    parser.add_argument("-lq", "--learn-queue", type=int, default=64, dest="learn_queue",
+                        help='Max number of pending learn requests of the async learner')
+    parser.add_argument("-p", "--param", action='append', default=[], dest="params",
+                        help='Override of a parameters/*.ini value for all the junctions, key=value, can be repeated')
+    parser.add_argument("--seed", type=int, default=None, dest="seed",
+                        help='Seed of python, numpy, torch and SUMO random generators')
+    parser.add_argument("--label", type=str, default="DeepRLight", dest="label",
+                        help='TraCI connection label, must be unique per SUMO instance of a process')
+    parser.add_argument("--log-root", type=str, default=None, dest="log_root",
+                        help='Logs directory, default: Networks/<network>/logs/<timestamp>')
+    parser.add_argument("--actors", type=int, default=0, dest="actors",
+                        help='Distributed training with this number of actor processes, 0 disables')
+    parser.add_argument("--actor-sync", type=int, default=100, dest="actor_sync",
+                        help='Number of learner updates between weights broadcasts to the actors')
+    parser.add_argument("-ci", "--checkpoint-interval", type=int, default=1, dest="checkpoint_interval",
+                        help='Save the full training state every checkpoint_interval episodes, 0 disables')
+    parser.add_argument("--resume", type=str, default=None, dest="resume",
+                        help='Logs directory of a run to resume from its last training state, the run keeps logging there')
+    parser.add_argument("-b", "--backend", type=str, default="traci", choices=['traci', 'libsumo'], dest="backend",
+                        help='TraCI implementation for non GUI episodes, GUI and capture episodes always use traci')
+    parser.add_argument("-rm", "--reset-mode", type=str, default="restart", choices=['restart', 'load'], dest="reset_mode",
+                        help='restart: new SUMO process every episode, load: keep SUMO running and reload the scenario')
+    parser.add_argument("-hu", "--heatup", type=int, default=20, dest="heatup",
+                        help='Max number of random warmup steps before every episode')
+    parser.add_argument("-ss", "--snapshots", type=int, default=0, dest="snapshots",
+                        help='Size of the pool of saved post heatup states to start episodes from, 0 disables')
+    parser.add_argument("-sc", "--scheduler", type=bool, default=False, dest="scheduler",
+                        help='Advance SUMO directly to the next junction decision instead of stepping every second')
+    parser.add_argument("-spt", "--sparse-transitions", type=bool, default=False, dest="sparse_transitions",
+                        help='With --scheduler, record a transition every sim_step steps between sim_step and min_green_duration '
+                             'instead of every step. Fewer, further apart transitions: tune eps_decay, replay_size and '
+                             'target_update of the .ini files again, they count transitions')
+    parser.add_argument("-is", "--idle-stride", type=int, default=0, dest="idle_stride",
+                        help='Fast forward in strides of idle_stride steps while the network is empty and no vehicle is expected, '
+                             'at most the sumo --route-steps (200 by default), 0 disables')
+    args = parser.parse_args(argv)
+    args.agent_params = dict(param.split("=", 1) for param in args.params)
+    if args.resume is not None:
+        args.log_root = args.resume
     args.network = os.path.join("Networks", args.network)
     args.cfg = os.path.join(args.network, "Config.sumocfg")
 
@@ -0,0 +1,84 @@
+import queue
+import threading
+import traceback
+
+
+class AsyncLearner:
+    '''
+    Runs the updates of DQN agents on a background thread, so SUMO keeps stepping during optimize_model.
+    The simulation loop only queues learn requests, every request is worth utd_ratio updates of the agent.
+    The agents act with a copy of their policy net which is refreshed every publish_interval updates.
+    Requests arriving while the queue is full are dropped (and counted), the simulation never waits for the learner.
+    An exception of an update stops the thread, it is reported and raised again on the simulation thread
+    by the next request() or paused(), so training never goes on with a frozen network.
+    '''
+    def __init__(self, agents, utd_ratio=1, publish_interval=10, queue_size=64):
+        self.utd_ratio = utd_ratio
+        self.publish_interval = publish_interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.requests = 0
+        self.dropped = 0
+        self.updates = 0
+        # Updates of every agent since its acting net was last published
+        self.unpublished = dict()
+        for agent in agents:
+            agent.enable_async()
+            self.unpublished[agent] = 0
+        # Held during the updates of a request, see paused()
+        self.lock = threading.Lock()
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def check(self):
+        if self.error is not None:
+            raise RuntimeError("the learner thread failed") from self.error
+
+    def request(self, agent):
+        self.check()
+        self.requests += 1
+        try:
+            self.queue.put_nowait(agent)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            agent = self.queue.get()
+            if agent is None:
+                return
+            try:
+                with self.lock:
+                    for _ in range(self.utd_ratio):
+                        agent.optimize_model()
+                        self.updates += 1
+                        self.unpublished[agent] += 1
+                        if self.unpublished[agent] >= self.publish_interval:
+                            agent.publish()
+                            self.unpublished[agent] = 0
+            except Exception as error:
+                print("Learner thread failed:")
+                traceback.print_exc()
+                self.error = error
+                return
+
+    def paused(self):
+        """ Context manager, no update runs inside it (e.g. to copy the nets and optimizers) """
+        self.check()
+        return self.lock
+
+    def metrics(self):
+        return {'queue_depth': self.queue.qsize(),
+                'requests': self.requests,
+                'dropped': self.dropped,
+                'updates': self.updates,
+                'utd_ratio': self.updates / max(self.requests, 1),
+                'staleness': max(self.unpublished.values(), default=0)}
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+        self.thread.join()
+        self.check()
+        for agent in self.unpublished:
+            agent.publish()
@@ -0,0 +1,36 @@
+import traci as traci_socket
+
+
+class Backend:
+    '''
+    Proxy to the TraCI implementation of the current SUMO connection.
+    'traci' talks to a separate SUMO process over a socket and is the only one that can drive sumo-gui,
+    'libsumo' runs SUMO inside this process without socket round-trips but has no GUI.
+    Both share the same API, so the rest of the code calls the proxy as if it was the traci module.
+    '''
+    names = ['traci', 'libsumo']
+
+    def __init__(self):
+        self.module = traci_socket
+        self.name = 'traci'
+
+    def use(self, name):
+        if name not in Backend.names:
+            raise NotImplementedError
+        if name == 'libsumo':
+            import libsumo
+            self.module = libsumo
+        else:
+            self.module = traci_socket
+        self.name = name
+
+    def start(self, cmd, label):
+        if self.name == 'traci':
+            return self.module.start(cmd, label=label)
+        return self.module.start(cmd)
+
+    def __getattr__(self, attr):
+        return getattr(self.module, attr)
+
+
+backend = Backend()
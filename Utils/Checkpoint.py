@@ -0,0 +1,115 @@
+import json
+import os
+import queue
+import shutil
+import threading
+import traceback
+import numpy as np
+import torch
+
+
+def save_arrays(folder, state):
+    """ The numpy arrays of state go to <key>.npy, the other values to state.json """
+    os.makedirs(folder, exist_ok=True)
+    values = dict()
+    for key, value in state.items():
+        if isinstance(value, np.ndarray):
+            np.save(os.path.join(folder, key + ".npy"), value)
+        else:
+            values[key] = value
+    with open(os.path.join(folder, "state.json"), "w") as f:
+        json.dump(values, f)
+
+
+def load_arrays(folder):
+    """ Inverse of save_arrays, the arrays are memory mapped """
+    with open(os.path.join(folder, "state.json")) as f:
+        state = json.load(f)
+    for file in os.listdir(folder):
+        if file.endswith(".npy"):
+            state[file[:-len(".npy")]] = np.load(os.path.join(folder, file), mmap_mode='r')
+    return state
+
+
+def latest(root):
+    """ Returns the folder of the last complete checkpoint under root, None if there is none """
+    path = os.path.join(root, "latest")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return os.path.join(root, f.read().strip())
+
+
+def load(folder):
+    '''
+    :return: network state, {name: (agent state, replay memory state)}
+    '''
+    with open(os.path.join(folder, "network.json")) as f:
+        network_state = json.load(f)
+    agents_states = dict()
+    for name in network_state['agents']:
+        agent_state = torch.load(os.path.join(folder, name, "agent.pth"), map_location='cpu')
+        agents_states[name] = (agent_state, load_arrays(os.path.join(folder, name, "memory")))
+    return network_state, agents_states
+
+
+class CheckpointWriter:
+    '''
+    Writes training checkpoints on a background thread, so the simulation never waits for torch.save.
+    Layout under root:
+        episode_<n>/network.json                  episode counter and network level state
+        episode_<n>/<agent name>/agent.pth        nets, optimizer and exploration state
+        episode_<n>/<agent name>/memory/*.npy     replay memory columns, memory mappable
+        latest                                    name of the last complete checkpoint
+    latest is replaced once a checkpoint is complete and the older checkpoints are removed after it,
+    so a crash while writing leaves the previous checkpoint usable.
+    '''
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def save(self, episode, network_state, agents_states):
+        """ Queue a checkpoint, the states must be copies the caller won't modify, see DQN_Agent.training_state """
+        self.queue.put((episode, network_state, agents_states))
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                return
+            try:
+                self.write(*job)
+            except Exception:
+                # The previous checkpoint stays the latest one, the next episodes are still saved
+                print("Checkpoint of episode " + str(job[0]) + " failed:")
+                traceback.print_exc()
+            finally:
+                self.queue.task_done()
+
+    def write(self, episode, network_state, agents_states):
+        name = "episode_%04d" % episode
+        folder = os.path.join(self.root, name)
+        for agent_name, (agent_state, memory_state) in agents_states.items():
+            os.makedirs(os.path.join(folder, agent_name), exist_ok=True)
+            torch.save(agent_state, os.path.join(folder, agent_name, "agent.pth"))
+            save_arrays(os.path.join(folder, agent_name, "memory"), memory_state)
+        network_state = dict(network_state, episode=episode, agents=list(agents_states.keys()))
+        with open(os.path.join(folder, "network.json"), "w") as f:
+            json.dump(network_state, f)
+        with open(os.path.join(self.root, "latest.tmp"), "w") as f:
+            f.write(name)
+        os.replace(os.path.join(self.root, "latest.tmp"), os.path.join(self.root, "latest"))
+        for old in os.listdir(self.root):
+            if old.startswith("episode_") and old != name:
+                shutil.rmtree(os.path.join(self.root, old), ignore_errors=True)
+
+    def wait(self):
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
@@ -3,19 +3,20 @@ import logging
 import io
 import csv
 import os
-import traci
+from Utils.Backend import backend as traci
 from io import StringIO
 import cv2
 import glob
 import time
 import matplotlib
-from PIL import Image, ImageDraw, ImageFont
-import subprocess
+import queue
+import shutil
+import tempfile
+import threading
+import traceback
 from subprocess import Popen, PIPE
 matplotlib.use('Agg')
 
-FFMPEG_SOURCE = "ffmpeg\\bin\\ffmpeg.exe"
-
 class CsvFormatter(logging.Formatter):
     def __init__(self):
         super().__init__(fmt='%(message)s')
@@ -104,49 +105,135 @@ class Logging:
         self.global_logger.info(msg)
 
 
+def ram_dir():
+    """ Directory of the short lived screenshot files, in memory when /dev/shm is available """
+    return '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+
+class VideoEncoder:
+    '''
+    mp4 encoder of BGR frames. The frames are piped raw to a persistent ffmpeg process when ffmpeg is on the PATH,
+    otherwise written with cv2.VideoWriter. The frames size is fixed by the first frame.
+    '''
+    def __init__(self, path, width, height, fps):
+        # yuv420p needs even dimensions
+        self.size = (width - width % 2, height - height % 2)
+        self.process = None
+        self.writer = None
+        ffmpeg = shutil.which("ffmpeg")
+        if ffmpeg is not None:
+            cmd = [ffmpeg, "-y", "-loglevel", "error", "-f", "rawvideo", "-pix_fmt", "bgr24",
+                   "-s", "%dx%d" % self.size, "-r", str(fps), "-i", "-",
+                   "-vcodec", "libx264", "-pix_fmt", "yuv420p", path]
+            self.process = Popen(cmd, stdin=PIPE)
+        else:
+            self.writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), fps, self.size)
+
+    def write(self, frame):
+        if (frame.shape[1], frame.shape[0]) != self.size:
+            frame = cv2.resize(frame, self.size)
+        if self.process is not None:
+            self.process.stdin.write(frame.tobytes())
+        else:
+            self.writer.write(frame)
+
+    def close(self):
+        if self.process is not None:
+            self.process.stdin.close()
+            self.process.wait()
+        else:
+            self.writer.release()
+
+
 class GUIScreenShot:
-    def __init__(self, path, name, view_id):
+    '''
+    Video of a GUI view during the capture episodes, <path>/<name>/<name>_<episode>.mp4.
+    sumo-gui writes the screenshot requested at a step during the next simulation step, so it is read back
+    (from a memory backed directory) at the next log, then the text is drawn and the frame encoded by a background thread.
+    A frame is taken every frame_interval simulation seconds.
+    '''
+    def __init__(self, path, name, view_id, frame_interval=1, fps=60):
         self.root = os.path.join(path, name)
         self.name = name
-        self.picture = None
-        self.video_path = os.path.join(self.root, self.name + ".mp4")
         os.makedirs(self.root, exist_ok=True)
         self.view = 'View #' + str(view_id)
-        self.conter = 0
-
-    def _handle_saved_pic(self):
-        img = Image.open(self.picture)
-        name = os.path.basename(self.picture).split(".")[0]
-        pic_episode = name.split("__")[0]
-        pic_time = name.split("__")[1].replace("_", ":")
-        #pic_reward = name.split("__")[2].replace("_", ".")
-        pic_cars = name.split("__")[3]
-        pic_mean_speed = name.split("__")[4].replace("_", ".")
-        pic_max_wt = name.split("__")[5].replace("_", ".")
-        draw = ImageDraw.Draw(img)
-        font = ImageFont.truetype("C:\\windows\\fonts\\stencil.ttf", 25, encoding="unic")
-        draw.text((0, 0), "Episode  " + pic_episode, fill='Black', font=font)
-        draw.text((0, 30), "Time  " + pic_time, fill='Black', font=font)
-        #draw.text((0, 60), "Reward  " + pic_reward, fill='Black', font=font)
-        img.save(os.path.join(self.root, "%08d" % self.conter + ".png"), quality=20, optimize=True)
-        self.conter += 1
-        os.remove(self.picture)
-
-
-    def log(self, episode, reward=None, num_cars=None, mean_speed=None, max_wt=None):
-        if self.picture is not None and os.path.exists(self.picture):
-            self._handle_saved_pic()
-        sim_time = time.strftime('%H_%M_%S', time.gmtime(traci.simulation.getTime()))
-        self.picture = os.path.join(self.root, str(episode) + "__" + sim_time + "__" + str(reward).replace(".","_") + "__" + str(num_cars) + "__" + str(mean_speed).replace(".","_") + "__" + str(max_wt).replace(".","_") + ".png")
+        self.frame_interval = frame_interval
+        self.fps = fps
+        self.frames_dir = None
+        self.picture = None
+        self.video_path = None
+        # Overlay text of the requested screenshot not read yet
+        self.pending = None
+        self.last_frame = None
+        self.queue = None
+        self.thread = None
+
+    def start(self, episode):
+        self.frames_dir = tempfile.mkdtemp(prefix="capture_", dir=ram_dir())
+        self.picture = os.path.join(self.frames_dir, "frame.bmp")
+        self.video_path = os.path.join(self.root, self.name + "_" + str(episode) + ".mp4")
+        self.last_frame = None
+        # Bounded, the simulation waits for the encoder rather than piling frames up
+        self.queue = queue.Queue(maxsize=64)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        encoder = None
+        failed = False
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if failed:
+                # Keep draining, the simulation must never block on a full queue
+                continue
+            frame, lines = item
+            try:
+                for i, line in enumerate(lines):
+                    cv2.putText(frame, line, (10, 30 + 30 * i), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 0), 2, cv2.LINE_AA)
+                if encoder is None:
+                    encoder = VideoEncoder(self.video_path, frame.shape[1], frame.shape[0], self.fps)
+                encoder.write(frame)
+            except Exception:
+                print("Capture of " + self.video_path + " failed, the next frames are dropped:")
+                traceback.print_exc()
+                failed = True
+        if encoder is not None:
+            try:
+                encoder.close()
+            except Exception:
+                traceback.print_exc()
+
+    def _read_pending(self):
+        if self.pending is None:
+            return
+        frame = cv2.imread(self.picture)
+        if frame is not None:
+            os.remove(self.picture)
+            self.queue.put((frame, self.pending))
+        self.pending = None
+
+    def log(self, episode, sim_time, reward=None, num_cars=None, mean_speed=None, max_wt=None):
+        if self.thread is None:
+            self.start(episode)
+        self._read_pending()
+        if self.last_frame is not None and sim_time - self.last_frame < self.frame_interval:
+            return
         if traci.gui.hasView(self.view):
+            self.last_frame = sim_time
+            self.pending = ["Episode  " + str(episode), "Time  " + time.strftime('%H:%M:%S', time.gmtime(sim_time))]
             traci.gui.screenshot(self.view, self.picture)
 
     def close(self):
-        cmd = FFMPEG_SOURCE + " -r 60 -start_number 0 -i " + os.path.join(self.root, "%08d.png") + " -vcodec libx264 " + self.video_path
-        os.system(cmd)
-        for f in os.listdir(self.root):
-            if f.endswith(".png"):
-                os.remove(os.path.join(self.root, f))
+        """ Finish the video of the episode """
+        if self.thread is None:
+            return
+        self._read_pending()
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        shutil.rmtree(self.frames_dir, ignore_errors=True)
 
 
 #Logger = Logging(stdout=True)
@@ -0,0 +1,152 @@
+"""
+SQLite store of the per episode aggregates of every junction of every run.
+Query from the command line:
+    python -m Utils.MetricsStore runs [-n double] [-p eps_decay=500 ...]
+    python -m Utils.MetricsStore curve <run> [-j B] [-m reward]
+    python -m Utils.MetricsStore best [-n double] [-m reward] [-k 10]
+"""
+import argparse
+import json
+import sqlite3
+import time
+
+metrics = ['mean_wait', 'max_wait', 'throughput', 'reward', 'phase_switches', 'steps', 'wall_time']
+
+schema = """
+CREATE TABLE IF NOT EXISTS runs (
+    run TEXT PRIMARY KEY,
+    network TEXT NOT NULL,
+    agent TEXT,
+    started REAL,
+    args TEXT
+);
+CREATE TABLE IF NOT EXISTS params (
+    run TEXT NOT NULL,
+    junction TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (run, junction, key)
+);
+CREATE TABLE IF NOT EXISTS episodes (
+    run TEXT NOT NULL,
+    network TEXT NOT NULL,
+    junction TEXT NOT NULL,
+    episode INTEGER NOT NULL,
+    mean_wait REAL,
+    max_wait REAL,
+    throughput INTEGER,
+    reward REAL,
+    phase_switches INTEGER,
+    steps INTEGER,
+    wall_time REAL,
+    PRIMARY KEY (run, junction, episode)
+);
+CREATE INDEX IF NOT EXISTS runs_network ON runs (network);
+CREATE INDEX IF NOT EXISTS params_key_value ON params (key, value);
+CREATE INDEX IF NOT EXISTS episodes_network_junction ON episodes (network, junction, episode);
+CREATE INDEX IF NOT EXISTS episodes_episode ON episodes (episode);
+"""
+
+
+class MetricsStore:
+    '''
+    Runs, their hyperparameters and the per episode aggregates of their junctions, in one SQLite file.
+    A run is identified by its logs directory. Several processes can write to the same file (WAL journal).
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(schema)
+
+    def add_run(self, run, network, agent, args, params):
+        '''
+        :param args: dict of the run arguments
+        :param params: {junction: {key: value}} hyperparameters, '' for the run level ones
+        '''
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?)",
+                                    (run, network, agent, time.time(), json.dumps(args, default=str)))
+            self.connection.executemany("INSERT OR REPLACE INTO params VALUES (?, ?, ?, ?)",
+                                        [(run, junction, key, str(value))
+                                         for junction, values in params.items() for key, value in values.items()])
+
+    def add_episodes(self, run, network, episode, aggregates):
+        """ :param aggregates: {junction: {metric: value}} """
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO episodes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                        [(run, network, junction, episode) + tuple(values.get(metric) for metric in metrics)
+                                         for junction, values in aggregates.items()])
+
+    def runs(self, network=None, **params):
+        """ Returns the runs of network (any if None) whose hyperparameters have all the given values """
+        query = "SELECT run FROM runs WHERE 1"
+        values = list()
+        if network is not None:
+            query += " AND network = ?"
+            values.append(network)
+        for key, value in params.items():
+            query += " AND run IN (SELECT run FROM params WHERE key = ? AND value = ?)"
+            values += [key, str(value)]
+        return [row[0] for row in self.connection.execute(query + " ORDER BY started", values)]
+
+    def learning_curve(self, run, metric='reward', junction=None):
+        """ Returns [(episode, value)] of a junction, or the mean over the junctions if junction is None """
+        if metric not in metrics:
+            raise ValueError("unknown metric " + metric)
+        if junction is None:
+            rows = self.connection.execute("SELECT episode, AVG(" + metric + ") FROM episodes WHERE run = ? "
+                                           "GROUP BY episode ORDER BY episode", (run,))
+        else:
+            rows = self.connection.execute("SELECT episode, " + metric + " FROM episodes WHERE run = ? AND junction = ? "
+                                           "ORDER BY episode", (run, junction))
+        return rows.fetchall()
+
+    def compare(self, runs, metric='reward', junction=None):
+        """ Returns {run: learning curve} """
+        return dict((run, self.learning_curve(run, metric, junction)) for run in runs)
+
+    def best(self, network=None, metric='reward', count=10, lowest=False):
+        """ Returns [(run, episode, value)] of the best episodes, mean over the junctions """
+        if metric not in metrics:
+            raise ValueError("unknown metric " + metric)
+        query = "SELECT run, episode, AVG(" + metric + ") AS value FROM episodes"
+        values = list()
+        if network is not None:
+            query += " WHERE network = ?"
+            values.append(network)
+        query += " GROUP BY run, episode ORDER BY value " + ("ASC" if lowest else "DESC") + " LIMIT ?"
+        return self.connection.execute(query, values + [count]).fetchall()
+
+    def close(self):
+        self.connection.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="DeepRLight metrics store queries")
+    parser.add_argument("-db", "--metrics-db", type=str, default="metrics.db", dest="db")
+    commands = parser.add_subparsers(dest="command", required=True)
+    runs_parser = commands.add_parser("runs", help='List the runs')
+    runs_parser.add_argument("-n", "--network", type=str, default=None, dest="network")
+    runs_parser.add_argument("-p", "--param", action='append', default=[], dest="params", help='key=value')
+    curve_parser = commands.add_parser("curve", help='Learning curve of a run')
+    curve_parser.add_argument("run", type=str)
+    curve_parser.add_argument("-j", "--junction", type=str, default=None, dest="junction")
+    curve_parser.add_argument("-m", "--metric", type=str, default="reward", choices=metrics, dest="metric")
+    best_parser = commands.add_parser("best", help='Best episodes')
+    best_parser.add_argument("-n", "--network", type=str, default=None, dest="network")
+    best_parser.add_argument("-m", "--metric", type=str, default="reward", choices=metrics, dest="metric")
+    best_parser.add_argument("-k", "--count", type=int, default=10, dest="count")
+    best_parser.add_argument("--lowest", type=bool, default=False, dest="lowest")
+    query_args = parser.parse_args()
+    store = MetricsStore(query_args.db)
+    if query_args.command == "runs":
+        for row in store.runs(query_args.network, **dict(param.split("=", 1) for param in query_args.params)):
+            print(row)
+    elif query_args.command == "curve":
+        for row in store.learning_curve(query_args.run, query_args.metric, query_args.junction):
+            print(row)
+    else:
+        for row in store.best(query_args.network, query_args.metric, query_args.count, query_args.lowest):
+            print(row)
+    store.close()
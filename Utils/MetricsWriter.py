@@ -0,0 +1,151 @@
+import csv
+import os
+import queue
+import threading
+import time
+import traceback
+import numpy as np
+
+
+class FlushWorker:
+    '''
+    Background thread shared by all the metrics writers, runs the file writes in the order they were queued.
+    '''
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, function, *args):
+        self.queue.put((function, args))
+
+    def run(self):
+        while True:
+            function, args = self.queue.get()
+            try:
+                function(*args)
+            except Exception:
+                # One failed write must not stop the thread shared by all the writers
+                print("Metrics " + function.__name__ + " of " + str(args[0]) + " failed:")
+                traceback.print_exc()
+            finally:
+                self.queue.task_done()
+
+    def wait(self):
+        self.queue.join()
+
+
+_worker = None
+
+
+def worker():
+    global _worker
+    if _worker is None:
+        _worker = FlushWorker()
+    return _worker
+
+
+def remove(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def write_chunk(path, names, buffers, rows):
+    """ A columns file is the array of the column names followed by chunks of one array per column """
+    new = not os.path.exists(path)
+    with open(path, "ab") as f:
+        if new:
+            np.save(f, np.array(names))
+        for name in names:
+            np.save(f, buffers[name][:rows])
+
+
+def read_metrics(path):
+    """ Returns {column: array} of a columns file """
+    with open(path, "rb") as f:
+        names = list(np.load(f))
+        chunks = dict((name, list()) for name in names)
+        size = os.fstat(f.fileno()).st_size
+        while f.tell() < size:
+            for name in names:
+                chunks[name].append(np.load(f))
+    return dict((name, np.concatenate(arrays)) for name, arrays in chunks.items() if len(arrays) > 0)
+
+
+def export_csv(path, csv_path):
+    """ CSV copy of a columns file, sim_time is written as HH:MM:SS """
+    if not os.path.exists(path):
+        return
+    columns = read_metrics(path)
+    if len(columns) == 0:
+        return
+    names = list(columns.keys())
+    with open(csv_path, "w", newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["#" + names[0]] + names[1:])
+        for row in zip(*[columns[name] for name in names]):
+            row = list(row)
+            if names[0] == 'sim_time':
+                row[0] = time.strftime('%H:%M:%S', time.gmtime(int(row[0])))
+            writer.writerow(row)
+
+
+class MetricsWriter:
+    '''
+    Typed columnar sink of per step statistics.
+    Rows are buffered in preallocated arrays, one per column, and full buffers are appended to
+    <path>/<name>.cols on the shared background thread, see write_chunk and read_metrics.
+    With csv=True every finished file is also exported to <path>/<name>.csv.
+    '''
+    def __init__(self, path, columns, buffer_size=4096, csv=False):
+        """ :param columns: list of (name, numpy dtype) """
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+        self.columns = columns
+        self.names = [name for name, _ in columns]
+        self.buffer_size = buffer_size
+        self.csv = csv
+        self.file = None
+        self.buffers = None
+        self.rows = 0
+        self.allocate()
+
+    def allocate(self):
+        self.buffers = dict((name, np.empty(self.buffer_size, dtype=dtype)) for name, dtype in self.columns)
+        self.rows = 0
+
+    def set_new_file(self, name):
+        self.close()
+        self.file = os.path.join(self.path, name + ".cols")
+        # Queued, so it runs after the pending writes of a previous file of the same name
+        worker().submit(remove, self.file)
+
+    def log(self, *values):
+        if self.file is None:
+            return
+        for name, value in zip(self.names, values):
+            self.buffers[name][self.rows] = value
+        self.rows += 1
+        if self.rows == self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """ Hand the buffered rows to the background thread """
+        if self.file is None or self.rows == 0:
+            return
+        worker().submit(write_chunk, self.file, self.names, self.buffers, self.rows)
+        self.allocate()
+
+    def close(self):
+        """ Flush the current file, and export it if csv is set """
+        if self.file is None:
+            return
+        self.flush()
+        if self.csv:
+            worker().submit(export_csv, self.file, os.path.splitext(self.file)[0] + ".csv")
+        self.file = None
+
+    @staticmethod
+    def wait():
+        """ Block until every queued write is on disk """
+        worker().wait()
@@ -0,0 +1,94 @@
+from Utils.Backend import backend as traci
+import traci.constants as tc
+
+
+def stage_type(stage):
+    """ VAR_STAGE is an int on old SUMO versions and a Stage object on new ones """
+    return getattr(stage, 'type', stage)
+
+
+class Observation:
+    '''
+    Per step snapshot of the TraCI subscriptions of a traffic network.
+    Lanes, edges and traffic lights are subscribed once per episode (subscriptions are dropped by traci.close),
+    SUMO sends all the results together with the simulationStep response,
+    so reading them from here costs no socket round-trips.
+    The vehicles and persons on the observed lanes and edges are subscribed the first time they are looked up
+    (SUMO drops their subscriptions when they leave): until their first results arrive with the next step,
+    they are queried directly. Lane and edge context subscriptions are not used, they miss some of the vehicles.
+    '''
+    lane_vars = [tc.LAST_STEP_VEHICLE_ID_LIST, tc.LAST_STEP_MEAN_SPEED, tc.LAST_STEP_OCCUPANCY,
+                 tc.LAST_STEP_VEHICLE_HALTING_NUMBER]
+    lane_vehicle_vars = [tc.VAR_SPEED, tc.VAR_ACCUMULATED_WAITING_TIME]
+    edge_vars = [tc.LAST_STEP_PERSON_ID_LIST]
+    person_vars = [tc.VAR_STAGE, tc.VAR_WAITING_TIME]
+    tls_vars = [tc.TL_CURRENT_PHASE]
+    simulation_vars = [tc.VAR_TIME, tc.VAR_DEPARTED_VEHICLES_IDS, tc.VAR_ARRIVED_VEHICLES_IDS]
+
+    def __init__(self):
+        self.time = 0
+        self.steps = 0
+        self.departed = ()
+        self.arrived = ()
+        self.lanes = dict()
+        self.edges = dict()
+        self.vehicles = dict()
+        self.persons = dict()
+        self.tls = dict()
+
+    def subscribe_simulation(self):
+        traci.simulation.subscribe(Observation.simulation_vars)
+
+    def subscribe_lane(self, lid):
+        traci.lane.subscribe(lid, Observation.lane_vars)
+
+    def subscribe_edge(self, eid):
+        traci.edge.subscribe(eid, Observation.edge_vars)
+
+    def subscribe_tls(self, jid):
+        traci.trafficlight.subscribe(jid, Observation.tls_vars)
+
+    def update(self):
+        """ Pull the results of the last simulation step, must be called after every traci.simulationStep() """
+        self.steps += 1
+        simulation = traci.simulation.getSubscriptionResults()
+        self.time = simulation.get(tc.VAR_TIME, self.time)
+        self.departed = simulation.get(tc.VAR_DEPARTED_VEHICLES_IDS, ())
+        self.arrived = simulation.get(tc.VAR_ARRIVED_VEHICLES_IDS, ())
+        self.lanes = traci.lane.getAllSubscriptionResults()
+        self.edges = traci.edge.getAllSubscriptionResults()
+        self.vehicles = dict(traci.vehicle.getAllSubscriptionResults())
+        self.persons = dict(traci.person.getAllSubscriptionResults())
+        self.tls = traci.trafficlight.getAllSubscriptionResults()
+
+    def lane(self, lid, var, default=0):
+        return self.lanes.get(lid, {}).get(var, default)
+
+    def lane_vehicle_ids(self, lid):
+        return self.lane(lid, tc.LAST_STEP_VEHICLE_ID_LIST, ())
+
+    def vehicle(self, vid):
+        """ {VAR_SPEED, VAR_ACCUMULATED_WAITING_TIME} of a vehicle in the network during the last step """
+        values = self.vehicles.get(vid)
+        if not values:
+            values = {tc.VAR_SPEED: traci.vehicle.getSpeed(vid),
+                      tc.VAR_ACCUMULATED_WAITING_TIME: traci.vehicle.getAccumulatedWaitingTime(vid)}
+            traci.vehicle.subscribe(vid, Observation.lane_vehicle_vars)
+            self.vehicles[vid] = values
+        return values
+
+    def edge_person_ids(self, eid):
+        return self.edges.get(eid, {}).get(tc.LAST_STEP_PERSON_ID_LIST, ())
+
+    def person(self, pid):
+        """ {VAR_STAGE, VAR_WAITING_TIME} of a person in the network during the last step """
+        values = self.persons.get(pid)
+        if not values:
+            values = {tc.VAR_STAGE: traci.person.getStage(pid),
+                      tc.VAR_WAITING_TIME: traci.person.getWaitingTime(pid)}
+            traci.person.subscribe(pid, Observation.person_vars, parameters={tc.VAR_STAGE: ("i", 0)})
+            self.persons[pid] = values
+        return values
+
+    def phase(self, jid):
+        return self.tls.get(jid, {}).get(tc.TL_CURRENT_PHASE, 0)
@@ -1,7 +1,7 @@
 import time
 
 import matplotlib
-import multiprocessing
+from multiprocessing import shared_memory
 matplotlib.use("TkAgg")
 import numpy as np
 import matplotlib.pyplot as plt
@@ -11,51 +11,116 @@ import matplotlib.animation as animation
 #plt.gca().set_aspect('equal', adjustable='box')
 #plt.style.use(['ggplot','dark_background'])
 
-class PlotAnimation:
-    def __init__(self, dump, communicator):
+def downsample(times, values, points):
+    """
+    Min/max decimation to about points samples: the min and the max of every bin,
+    so the peaks a plain stride would skip stay visible. values are [fields, rows].
+    """
+    bins = points // 2
+    if len(times) <= points:
+        return times, values
+    size = len(times) // bins
+    # The most recent rows are always kept, the oldest partial bin is dropped
+    rows = size * bins
+    times = times[-rows:].reshape(bins, size)
+    values = values[:, -rows:].reshape(len(values), bins, size)
+    x = np.stack([times[:, 0], times[:, -1]], axis=1).reshape(-1)
+    y = np.stack([values.min(axis=2), values.max(axis=2)], axis=2).reshape(len(values), -1)
+    return x, y
 
-        self.data = dict()
-        self.fig = plt.figure()
-        self.communicator = communicator
-        self.updater = None
-        self.xlim_max = 1
-        self.ylim_max = 1
-        for i, name in enumerate(dump.keys()):
-            self.data[name] = dict()
-            self.data[name]['ax'] = self.fig.add_subplot(len(list(dump.keys())), 1, i+1)
 
+class PlotBuffer:
+    '''
+    Fixed size ring of the plotted statistics of every junction in shared memory.
+    The simulator writes the rows in place and the plot process reads them, nothing is pickled or queued.
+    Layout: int64 count of written rows, then float64 [junctions, time + fields, capacity].
+    A single writer, the count is increased once the row is complete.
+    '''
+    fields = ('cars', 'max_wt', 'mean_speed')
+
+    def __init__(self, junctions, capacity, name=None):
+        """ :param name: shared memory block to attach to, a new one is created if None """
+        self.junctions = list(junctions)
+        self.capacity = capacity
+        shape = (len(self.junctions), 1 + len(self.fields), capacity)
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=8 + int(np.prod(shape)) * 8)
+        self.count = np.ndarray((1,), dtype=np.int64, buffer=self.shm.buf)
+        self.data = np.ndarray(shape, dtype=np.float64, buffer=self.shm.buf, offset=8)
+        if self.owner:
+            self.count[0] = 0
+
+    def attach_args(self):
+        """ Arguments of PlotBuffer to attach to this block from another process """
+        return self.junctions, self.capacity, self.shm.name
+
+    def write(self, dump):
+        """ :param dump: {jid: {'time', 'cars', 'max_wt', 'mean_speed'}} """
+        count = int(self.count[0])
+        row = count % self.capacity
+        for i, jid in enumerate(self.junctions):
+            values = dump[jid]
+            self.data[i, :, row] = [values['time']] + [values[field] for field in self.fields]
+        self.count[0] = count + 1
+
+    def clear(self):
+        self.count[0] = 0
+
+    def window(self):
+        """ Copy of the rows in the ring, oldest first """
+        count = int(self.count[0])
+        if count <= self.capacity:
+            return self.data[:, :, :count].copy()
+        row = count % self.capacity
+        return np.concatenate([self.data[:, :, row:], self.data[:, :, :row]], axis=2)
+
+    def close(self):
+        # The numpy views must be released before the block
+        self.count = None
+        self.data = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class PlotAnimation:
+    '''
+    Live plot of a PlotBuffer, redrawn at a fixed frame rate whatever the simulation speed,
+    from at most points min/max downsampled samples per line.
+    '''
+    def __init__(self, buffer, fps=10, points=2000):
+        self.buffer = buffer
+        self.points = points
+        self.fig = plt.figure()
+        self.lines = list()
+        for i, name in enumerate(buffer.junctions):
+            ax = self.fig.add_subplot(len(buffer.junctions), 1, i+1)
             plt.xlabel("Seconds")
-            self.data[name]['ax'].set_title("Junction " + name)
-            self.data[name]['ax'].set_xlim(0, 3600*24)
-            self.data[name]['ax'].set_ylim(0, 100)
-            self.data[name]['lines'] = dict()
-            for field in dump[name].keys():
-                if field == 'time':
-                    continue
-                line, = self.data[name]['ax'].plot([], [], label=field)
-                plt.legend()
-                plt.legend(loc='center left', bbox_to_anchor=(1, 0.5))
-                self.data[name]['lines'][field] = line
-            if i == 0:
-                self.updater = name
-            for field in dump[name].keys():
-                self.data[name][field] = list()
+            ax.set_title("Junction " + name)
+            ax.set_xlim(0, 3600*24)
+            ax.set_ylim(0, 100)
+            lines = list()
+            for field in buffer.fields:
+                line, = ax.plot([], [], label=field)
+                lines.append(line)
+            plt.legend(loc='center left', bbox_to_anchor=(1, 0.5))
+            self.lines.append(lines)
         plt.subplots_adjust(hspace=0.5)
-        ani = animation.FuncAnimation(self.fig, self.update, fargs=(communicator,), interval=10, blit=True)
+        ani = animation.FuncAnimation(self.fig, self.update, interval=1000 / fps, blit=True, cache_frame_data=False)
         plt.show()
 
-    def update(self, frame, communicator):
-        lines = []
-        dump = communicator.get()
-        for name in dump.keys():
-            for field in dump[name].keys():
-                self.data[name][field].append(dump[name][field])
-                if field == 'time':
-                    continue
-                self.data[name]['lines'][field].set_data(self.data[name]['time'], self.data[name][field])
-                lines.append(self.data[name]['lines'][field])
-        return lines
-
-def animation_process(data, communicators):
-    PlotAnimation(data, communicators)
+    def update(self, frame):
+        window = self.buffer.window()
+        updated = []
+        for i, lines in enumerate(self.lines):
+            times, values = downsample(window[i, 0], window[i, 1:], self.points)
+            for line, value in zip(lines, values):
+                line.set_data(times, value)
+                updated.append(line)
+        return updated
+
 
+def animation_process(junctions, capacity, name):
+    buffer = PlotBuffer(junctions, capacity, name)
+    PlotAnimation(buffer)
+    buffer.close()
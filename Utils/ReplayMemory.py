@@ -1,26 +1,282 @@
+
+import os
 import random
+import numpy as np
+import torch
 from collections import namedtuple
+try:
+    import fcntl
+except ImportError:
+    # No file locks (Windows), a mapped memory can only be used by one process at a time
+    fcntl = None
 
 Transition = namedtuple('Transition',
                         ('state', 'action', 'next_state', 'reward'))
 
 class ReplayMemory(object):
-
-    def __init__(self, capacity):
+    '''
+    Ring buffer of transitions stored in preallocated contiguous arrays, one row per transition.
+    '''
+    def __init__(self, capacity, state_size):
         self.capacity = capacity
-        self.memory = []
+        self.state_size = state_size
+        self.states = np.zeros((capacity, state_size), dtype=np.float32)
+        self.actions = np.zeros((capacity, 1), dtype=np.int64)
+        self.next_states = np.zeros((capacity, state_size), dtype=np.float32)
+        self.rewards = np.zeros((capacity, 1), dtype=np.float32)
         self.position = 0
+        self.size = 0
 
-    def push(self, *args):
+    def push(self, state, action, next_state, reward):
         """Saves a transition."""
-        if len(self.memory) < self.capacity:
-            self.memory.append(None)
-        self.memory[self.position] = Transition(*args)
+        self.states[self.position] = state
+        self.actions[self.position] = action
+        self.next_states[self.position] = next_state
+        self.rewards[self.position] = reward
         self.position = (self.position + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def sample_indices(self, batch_size):
+        return np.array(random.sample(range(self.size), batch_size))
+
+    def get(self, indices):
+        """ Returns Transition of batch tensors of the given rows """
+        return Transition(torch.from_numpy(self.states[indices]),
+                          torch.from_numpy(self.actions[indices]),
+                          torch.from_numpy(self.next_states[indices]),
+                          torch.from_numpy(self.rewards[indices]))
 
     def sample(self, batch_size):
-        return random.sample(self.memory, batch_size)
+        return self.get(self.sample_indices(batch_size))
+
+    def state_dict(self):
+        """ Copy of the stored rows and of the ring position, numpy arrays and plain values """
+        return {'states': self.states[:self.size].copy(),
+                'actions': self.actions[:self.size].copy(),
+                'next_states': self.next_states[:self.size].copy(),
+                'rewards': self.rewards[:self.size].copy(),
+                'position': self.position,
+                'size': self.size}
+
+    def load_state_dict(self, state):
+        """ Restore a state_dict, the arrays may be memory mapped """
+        self.size = min(int(state['size']), self.capacity)
+        self.position = int(state['position']) % self.capacity
+        self.states[:self.size] = state['states'][:self.size]
+        self.actions[:self.size] = state['actions'][:self.size]
+        self.next_states[:self.size] = state['next_states'][:self.size]
+        self.rewards[:self.size] = state['rewards'][:self.size]
 
     def __len__(self):
-        return len(self.memory)
+        return self.size
+
+
+class FileLock(object):
+    '''
+    fcntl lock of a file, shared for readers and exclusive for writers, held by the process inside a with block.
+    '''
+    def __init__(self, path):
+        self.file = open(path, "a+")
+
+    def shared(self):
+        return _Locked(self.file, None if fcntl is None else fcntl.LOCK_SH)
+
+    def exclusive(self):
+        return _Locked(self.file, None if fcntl is None else fcntl.LOCK_EX)
+
+
+class _Locked(object):
+    def __init__(self, file, operation):
+        self.file = file
+        self.operation = operation
+
+    def __enter__(self):
+        if self.operation is not None:
+            fcntl.flock(self.file, self.operation)
+
+    def __exit__(self, *exc):
+        if self.operation is not None:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+
+
+class MappedReplayMemory(ReplayMemory):
+    '''
+    Ring buffer of transitions in a memory mapped file, for capacities beyond RAM and for sharing one buffer
+    between junctions and processes. Every process opening the same path (with the same capacity and state size)
+    appends to and samples from the same transitions, the rows are read in place.
+    File layout: header of 8 int64 (magic, version, capacity, state_size, position, size, written, 0),
+    then the states, actions, next_states and rewards columns, each aligned to 64 bytes.
+    Writers hold an exclusive lock of <path>.lock, readers a shared one.
+    '''
+    magic = 0x524c5250  # "RLRP"
+    version = 1
+    header_size = 8
+    MAGIC, VERSION, CAPACITY, STATE_SIZE, POSITION, SIZE, WRITTEN = range(7)
+
+    def __init__(self, capacity, state_size, path):
+        self.capacity = capacity
+        self.state_size = state_size
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.lock = FileLock(path + ".lock")
+        columns = [('states', np.float32, (capacity, state_size)),
+                   ('actions', np.int64, (capacity, 1)),
+                   ('next_states', np.float32, (capacity, state_size)),
+                   ('rewards', np.float32, (capacity, 1))]
+        offsets = list()
+        offset = self.header_size * 8
+        for _, dtype, shape in columns:
+            offsets.append(offset)
+            offset += -(-np.dtype(dtype).itemsize * int(np.prod(shape)) // 64) * 64
+        with self.lock.exclusive():
+            if not os.path.exists(path) or os.path.getsize(path) == 0:
+                with open(path, "wb") as f:
+                    # Sparse file, the pages are allocated when written
+                    f.truncate(offset)
+                header = np.memmap(path, dtype=np.int64, mode='r+', shape=(self.header_size,))
+                header[:4] = [self.magic, self.version, capacity, state_size]
+                header.flush()
+            self.header = np.memmap(path, dtype=np.int64, mode='r+', shape=(self.header_size,))
+            if self.header[self.MAGIC] != self.magic or self.header[self.VERSION] != self.version or \
+                    self.header[self.CAPACITY] != capacity or self.header[self.STATE_SIZE] != state_size:
+                raise ValueError(path + " is not a replay memory of capacity " + str(capacity) +
+                                 " and state size " + str(state_size))
+        for (name, dtype, shape), column_offset in zip(columns, offsets):
+            setattr(self, name, np.memmap(path, dtype=dtype, mode='r+', offset=column_offset, shape=shape))
+
+    @property
+    def position(self):
+        return int(self.header[self.POSITION])
+
+    @property
+    def size(self):
+        return int(self.header[self.SIZE])
+
+    def push(self, state, action, next_state, reward):
+        """Saves a transition."""
+        with self.lock.exclusive():
+            position = self.position
+            self.states[position] = state
+            self.actions[position] = action
+            self.next_states[position] = next_state
+            self.rewards[position] = reward
+            self.header[self.POSITION] = (position + 1) % self.capacity
+            self.header[self.SIZE] = min(self.size + 1, self.capacity)
+            self.header[self.WRITTEN] += 1
+
+    def sample_indices(self, batch_size):
+        # Rows may be sampled more than once, random.sample over tens of millions of rows is slow
+        return np.random.randint(self.size, size=batch_size)
+
+    def get(self, indices):
+        with self.lock.shared():
+            return Transition(*(torch.from_numpy(np.asarray(column[indices]))
+                                for column in (self.states, self.actions, self.next_states, self.rewards)))
+
+    def state_dict(self):
+        """ The transitions are already on disk, only the file is flushed and referenced """
+        for column in (self.header, self.states, self.actions, self.next_states, self.rewards):
+            column.flush()
+        return {'path': self.path, 'position': self.position, 'size': self.size}
+
+    def load_state_dict(self, state):
+        """ Nothing to restore, the file is the state """
+        if os.path.abspath(state['path']) != os.path.abspath(self.path):
+            raise ValueError("the checkpoint replay memory is " + state['path'] + ", not " + self.path)
+
+
+class SumTree(object):
+    '''
+    Array backed binary tree, every parent holds the sum of its children and the leaves hold the priorities.
+    Updating a priority and finding the leaf of a prefix sum are O(log n).
+    '''
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.tree = np.zeros(2 * capacity - 1, dtype=np.float64)
+
+    def total(self):
+        return self.tree[0]
+
+    def get(self, indices):
+        return self.tree[np.asarray(indices) + self.capacity - 1]
+
+    def update(self, index, priority):
+        node = index + self.capacity - 1
+        change = priority - self.tree[node]
+        self.tree[node] = priority
+        while node > 0:
+            node = (node - 1) // 2
+            self.tree[node] += change
+
+    def find(self, value):
+        """ Returns the index of the leaf where the prefix sum of the priorities reaches value """
+        node = 0
+        while node < self.capacity - 1:
+            left = 2 * node + 1
+            if value <= self.tree[left]:
+                node = left
+            else:
+                value -= self.tree[left]
+                node = left + 1
+        return node - (self.capacity - 1)
+
+
+class PrioritizedReplayMemory(ReplayMemory):
+    '''
+    Prioritized experience replay (Schaul et al. 2015, proportional variant).
+    Transitions are sampled with probability p^alpha / sum(p^alpha) where p is the last TD error,
+    new transitions get the max priority so they are replayed at least once.
+    The bias is corrected by importance sampling weights (N * P)^-beta, beta is annealed to 1.
+    '''
+    def __init__(self, capacity, state_size, alpha=0.6, beta=0.4, beta_increment=0.001, eps=1e-6):
+        super().__init__(capacity, state_size)
+        self.tree = SumTree(capacity)
+        self.alpha = alpha
+        self.beta = beta
+        self.beta_increment = beta_increment
+        self.eps = eps
+        self.max_priority = 1.0
+
+    def push(self, state, action, next_state, reward):
+        self.tree.update(self.position, self.max_priority ** self.alpha)
+        super().push(state, action, next_state, reward)
+
+    def sample_indices(self, batch_size):
+        # One sample from each of batch_size equal segments of the total priority
+        segment = self.tree.total() / batch_size
+        values = (np.arange(batch_size) + np.random.rand(batch_size)) * segment
+        return np.minimum([self.tree.find(value) for value in values], self.size - 1)
+
+    def sample_prioritized(self, batch_size):
+        """ Returns Transition of batch tensors, the sampled indices and the importance sampling weights """
+        indices = self.sample_indices(batch_size)
+        probabilities = self.tree.get(indices) / self.tree.total()
+        weights = (self.size * probabilities) ** (-self.beta)
+        weights = weights / weights.max()
+        self.beta = min(1.0, self.beta + self.beta_increment)
+        return self.get(indices), indices, torch.from_numpy(weights.astype(np.float32)).unsqueeze(1)
+
+    def update_priorities(self, indices, td_errors):
+        priorities = np.abs(td_errors) + self.eps
+        self.max_priority = max(self.max_priority, float(priorities.max()))
+        for index, priority in zip(indices, priorities):
+            self.tree.update(index, priority ** self.alpha)
+
+    def state_dict(self):
+        state = super().state_dict()
+        state['tree'] = self.tree.tree.copy()
+        state['max_priority'] = float(self.max_priority)
+        state['beta'] = self.beta
+        return state
 
+    def load_state_dict(self, state):
+        super().load_state_dict(state)
+        if len(state['tree']) == len(self.tree.tree):
+            self.tree.tree[:] = state['tree']
+        else:
+            # Other capacity, priorities are rebuilt at the max priority
+            self.tree = SumTree(self.capacity)
+            for index in range(self.size):
+                self.tree.update(index, float(state['max_priority']) ** self.alpha)
+        self.max_priority = float(state['max_priority'])
+        self.beta = float(state['beta'])
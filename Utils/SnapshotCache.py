@@ -0,0 +1,56 @@
+import hashlib
+import os
+import random
+import xml.etree.ElementTree as ET
+from Utils.Backend import backend as traci
+
+
+class SnapshotCache:
+    '''
+    Pool of post heatup simulation states of a scenario.
+    States are saved with traci.simulation.saveState under Networks/<net>/snapshots/<scenario hash>/,
+    the hash covers the sumo config, the network, route and additional files and the heatup length,
+    so changing any of them starts a new pool.
+    '''
+    def __init__(self, cfg, pool_size, heatup):
+        self.cfg = cfg
+        self.pool_size = pool_size
+        self.heatup = heatup
+        self.root = os.path.join(os.path.dirname(cfg), 'snapshots', self.scenario_hash())
+        os.makedirs(self.root, exist_ok=True)
+
+    def scenario_files(self):
+        """ Returns the paths of the files the sumo config loads """
+        files = [self.cfg]
+        inputs = ET.parse(self.cfg).getroot().find('input')
+        for tag in ('net-file', 'route-files', 'additional-files'):
+            element = inputs.find(tag) if inputs is not None else None
+            if element is None:
+                continue
+            for name in element.get('value').split(","):
+                files.append(os.path.join(os.path.dirname(self.cfg), name.strip()))
+        return files
+
+    def scenario_hash(self):
+        sha = hashlib.sha1()
+        for path in self.scenario_files():
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b''):
+                        sha.update(chunk)
+        sha.update(str(self.heatup).encode())
+        return sha.hexdigest()[:16]
+
+    def states(self):
+        return sorted(os.path.join(self.root, f) for f in os.listdir(self.root) if f.endswith(".xml.gz"))
+
+    def is_full(self):
+        return len(self.states()) >= self.pool_size
+
+    def save(self):
+        """ Save the current simulation state into the pool """
+        traci.simulation.saveState(os.path.join(self.root, "state_%04d.xml.gz" % len(self.states())))
+
+    def load(self):
+        """ Load a random state of the pool into the running simulation """
+        traci.simulation.loadState(random.choice(self.states()))
@@ -0,0 +1,99 @@
+import gzip
+import hashlib
+import json
+import os
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+from sumolib import net
+from sumolib.net.lane import SUMO_VEHICLE_CLASSES
+
+# Same fields as the phases of traci.trafficlight.getCompleteRedYellowGreenDefinition used by Junction
+Phase = namedtuple('Phase', ('state', 'duration'))
+
+
+def net_file(cfg):
+    """ Returns the path of the network file of a sumo config """
+    inputs = ET.parse(cfg).getroot().find('input')
+    return os.path.join(os.path.dirname(cfg), inputs.find('net-file').get('value'))
+
+
+def allowed(lane):
+    """ Allowed classes of a sumolib lane as traci.lane.getAllowed, empty when every class is allowed """
+    permissions = lane.getPermissions()
+    return [] if len(permissions) >= len(SUMO_VEHICLE_CLASSES) else sorted(permissions)
+
+
+class Topology:
+    '''
+    Static description of the traffic lights of a network: controlled lanes and their geometry, edges and programs.
+    It is read once from the .net.xml with sumolib and cached in Networks/<net>/topology/<net file hash>.json.gz,
+    so building the junctions needs no SUMO process.
+    The values are the ones TraCI returns at the start of the simulation:
+    - lanes allowed classes are empty when every class is allowed, as traci.lane.getAllowed,
+    - the programs and phases are those of the first program of every traffic light in the net file,
+      which starts on its first phase.
+    '''
+    version = 1
+
+    def __init__(self, cfg):
+        self.net_file = net_file(cfg)
+        self.path = os.path.join(os.path.dirname(cfg), 'topology', self.net_hash() + '.json.gz')
+        if os.path.exists(self.path):
+            with gzip.open(self.path, 'rt') as f:
+                self.data = json.load(f)
+        else:
+            self.data = self.read()
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + '.' + str(os.getpid()) + '.tmp'
+            with gzip.open(tmp, 'wt') as f:
+                json.dump(self.data, f, separators=(',', ':'))
+            # Other processes starting at the same time never read a partial file
+            os.replace(tmp, self.path)
+
+    def net_hash(self):
+        sha = hashlib.sha1()
+        with open(self.net_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+        sha.update(str(Topology.version).encode())
+        return sha.hexdigest()[:16]
+
+    def read(self):
+        network = net.readNet(self.net_file, withPrograms=True)
+        data = {'tls': dict(), 'lanes': dict(), 'edges': dict()}
+        for tls in network.getTrafficLights():
+            connections = sorted(tls.getConnections(), key=lambda connection: connection[2])
+            program_id, program = list(tls.getPrograms().items())[0]
+            data['tls'][tls.getID()] = {'controlled_lanes': [connection[0].getID() for connection in connections],
+                                        'program': program_id,
+                                        'phases': [[phase.state, phase.duration] for phase in program.getPhases()]}
+            for connection in connections:
+                lane = connection[0]
+                data['lanes'][lane.getID()] = {'edge': lane.getEdge().getID(),
+                                               'length': lane.getLength(),
+                                               'width': lane.getWidth(),
+                                               'shape': [list(point) for point in lane.getShape()],
+                                               'allowed': allowed(lane)}
+                data['edges'][lane.getEdge().getID()] = {'lanes': lane.getEdge().getLaneNumber()}
+        return data
+
+    def tls_ids(self):
+        # Sorted as traci.trafficlight.getIDList
+        return sorted(self.data['tls'].keys())
+
+    def controlled_lanes(self, jid):
+        return self.data['tls'][jid]['controlled_lanes']
+
+    def program(self, jid):
+        return self.data['tls'][jid]['program']
+
+    def phases(self, jid):
+        return [Phase(state, duration) for state, duration in self.data['tls'][jid]['phases']]
+
+    def lane(self, lid):
+        """ {'edge', 'length', 'width', 'shape', 'allowed'} """
+        return self.data['lanes'][lid]
+
+    def edge(self, eid):
+        """ {'lanes'} """
+        return self.data['edges'][eid]
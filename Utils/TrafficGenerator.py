@@ -1,19 +1,19 @@
+import heapq
 import random as rand
 import xml.etree.ElementTree as ET
-from xml.dom import minidom
+from xml.sax.saxutils import quoteattr
 from sumolib import checkBinary, net
 import traci
 import matplotlib.pyplot as plt
 #from pylab import *
 import numpy as np
-from scipy import stats
 import random
 
 class TrafficNetwork:
     def __init__(self, net_xml, routes_xml, walks_xml):
         self.network = net.readNet(net_xml)
-        self.walks = set(random.sample([node.attributes['edges'].value for node in minidom.parse(walks_xml).getElementsByTagName('walk')], 50))
-        self.routes = set([node.attributes['edges'].value for node in minidom.parse(routes_xml).getElementsByTagName('route')])
+        self.walks = set(random.sample([node.get('edges') for node in ET.parse(walks_xml).iter('walk')], 50))
+        self.routes = set([node.get('edges') for node in ET.parse(routes_xml).iter('route')])
         self.junctions = None
 
     def parse(self):
@@ -82,11 +82,6 @@ class TrafficGenerator:
     def __init__(self, network):
         self._network = network
 
-    def prettify(self, elem):
-        rough_string = ET.tostring(elem, 'utf-8')
-        reparsed = minidom.parseString(rough_string)
-        return reparsed.toprettyxml(indent="  ")
-
     def generate_types(self):
         typeElements = list()
         types = list()
@@ -135,36 +130,62 @@ class TrafficGenerator:
         vClassParam = VType.default[vtype]['perHour']
         return int(0.4 * factor * start_edge_lanes * vClassParam * end_edge_lanes * self.time_probability(hour))
 
-    def generate_flow(self, types, pedTypes):
+    def hour_departures(self, start_hour, counts):
+        """
+        Departure times of one hour, sampled at once for every source
+        :param counts: number of departures of every source (route and vType, or walk and pedestrian type)
+        :return: departure times, source index and generation index of every departure, sorted by departure time
+        """
+        sources = np.repeat(np.arange(len(counts)), counts)
+        departs = np.random.randint(start_hour, start_hour + 3600, size=len(sources))
+        # Stable, departures at the same second keep the generation order
+        order = np.argsort(departs, kind='stable')
+        return departs[order], sources[order], order
+
+    def vehicles_stream(self, start_hour, routes, types, counter):
+        hour = (start_hour % 86400) / 3600
+        counts = [self.gen_vehicles_per_hour(vehicle['vClass'], route.split(" ")[0], route.split(" ")[-1], hour)
+                  for route in routes for vehicle in types]
+        departs, sources, order = self.hour_departures(start_hour, counts)
+        prefixes = [vehicle['id'] + "_" + route.split(" ")[0] + "_" + route.split(" ")[-1] + "_"
+                    for route in routes for vehicle in types]
+        for depart, source, index in zip(departs.tolist(), sources.tolist(), order.tolist()):
+            route = routes[source // len(types)]
+            vehicle = types[source % len(types)]
+            yield depart, ('   <vehicle id=' + quoteattr(prefixes[source] + str(depart) + "_" + str(counter + index)) +
+                           ' depart="' + str(depart) + '" type=' + quoteattr(vehicle['id']) + '>\n'
+                           '      <route edges=' + quoteattr(route) + '/>\n'
+                           '   </vehicle>\n')
+
+    def pedestrians_stream(self, start_hour, walks, pedTypes, counter):
+        hour = (start_hour % 86400) / 3600
+        counts = [self.time_probability(hour) for _ in walks for _ in pedTypes]
+        departs, sources, order = self.hour_departures(start_hour, counts)
+        for depart, source, index in zip(departs.tolist(), sources.tolist(), order.tolist()):
+            walk = walks[source // len(pedTypes)]
+            ped = pedTypes[source % len(pedTypes)]
+            yield depart, ('   <person id=' + quoteattr(ped['id'] + "_" + str(counter + index)) +
+                           ' depart="' + str(depart) + '" type=' + quoteattr(ped['id']) + '>\n'
+                           '      <walk edges=' + quoteattr(walk) + '/>\n'
+                           '   </person>\n')
+
+    def generate_flow(self, types, pedTypes, days=1):
+        """
+        Generator of the vehicle and person elements as XML text, sorted by departure time.
+        Only one hour of departures is sampled at a time: the hours do not overlap, so they are chained,
+        and the vehicles and persons of an hour are merged by departure time, vehicles first on ties.
+        """
         counter = 0
         pedestrian_counter = 0
-        flows = list()
         routes = self._network.find_routes()
-        hours = np.linspace(start=0, stop=23*3600, num=24, dtype=int)
-        for start_hour in hours:
-            for route in routes:
-                for vehicle in types:
-                    num_vehicles = self.gen_vehicles_per_hour(vehicle['vClass'], route.split(" ")[0], route.split(" ")[-1], start_hour/3600)
-                    departure_times = stats.randint.rvs(start_hour, start_hour+3600, size=num_vehicles)
-                    for time in departure_times:
-                        vehicle_element = ET.Element('vehicle', attrib={'id': vehicle['id'] + "_" + route.split(" ")[0] + "_" + route.split(" ")[-1]+ "_" + str(time) + "_" + str(counter),
-                                                                        'depart': str(time),
-                                                                        'type' : vehicle['id']
-                                                                        })
-                        ET.SubElement(vehicle_element, 'route', edges=route)
-                        flows.append(vehicle_element)
-                        counter += 1
-            for walk in self._network.get_walks():
-                for ped in pedTypes:
-                    num_pedestrians = self.time_probability(start_hour/3600)
-                    departure_times = stats.randint.rvs(start_hour, start_hour + 3600, size=num_pedestrians)
-                    for time in departure_times:
-                        pedestrian_element = ET.Element('person', attrib={'id' : ped['id'] + "_" + str(pedestrian_counter), 'depart': str(time), 'type': ped['id']})
-                        ET.SubElement(pedestrian_element, 'walk', edges=walk)
-                        flows.append(pedestrian_element)
-                        pedestrian_counter += 1
-        flows.sort(key=lambda x: int(x.get('depart')))
-        return flows
+        walks = list(self._network.get_walks())
+        for start_hour in range(0, days * 24 * 3600, 3600):
+            vehicles = list(self.vehicles_stream(start_hour, routes, types, counter))
+            pedestrians = list(self.pedestrians_stream(start_hour, walks, pedTypes, pedestrian_counter))
+            counter += len(vehicles)
+            pedestrian_counter += len(pedestrians)
+            for _, element in heapq.merge(vehicles, pedestrians, key=lambda departure: departure[0]):
+                yield element
 
     def generate_pedestrians(self):
         typeElements = list()
@@ -173,19 +194,16 @@ class TrafficGenerator:
         typeElements.append(ET.Element('vType', {'vClass': 'pedestrian', 'guiShape': 'pedestrian', 'id': 'pedestrian_1', 'color': 'blue', 'width':'0.7', 'length': '0.35', 'minGap':'0.1'}))
         return typeElements, types
 
-    def generate_xml(self, name):
-        root = ET.Element('routes')
+    def generate_xml(self, name, days=1):
+        """ Writes the routes file incrementally, the memory used does not depend on the number of days """
         typeElements, types = self.generate_types()
-        root.extend(typeElements)
         pedTypeElements, pedTypes = self.generate_pedestrians()
-        root.extend(pedTypeElements)
-        #root.extend(self.generate_routes())
-        root.extend(self.generate_flow(types, pedTypes))
-        tree= ET.ElementTree(root)
-        xmlstr = minidom.parseString(ET.tostring(root)).toprettyxml(indent="   ", encoding='UTF-8')
-        with open(name, "w") as f:
-            f.write(str(xmlstr.decode('UTF-8')))
-            f.close()
+        with open(name, "w", encoding='UTF-8') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n<routes>\n')
+            for element in typeElements + pedTypeElements:
+                f.write('   ' + ET.tostring(element, encoding='unicode') + '\n')
+            f.writelines(self.generate_flow(types, pedTypes, days))
+            f.write('</routes>\n')
 
 
 def extractRoutes(file):
@@ -217,11 +235,11 @@ def plot_generated(file):
     array = []
     edges = set()
     types = set()
-    vehicles = minidom.parse(file).getElementsByTagName('vehicle')
+    vehicles = ET.parse(file).iter('vehicle')
     for vehicle in vehicles:
-        type = vehicle.getAttribute('type').split("_")[0]
-        time = int(vehicle.getAttribute('depart'))
-        edge = vehicle.getElementsByTagName('route')[0].getAttribute('edges').split(" ")[0]
+        type = vehicle.get('type').split("_")[0]
+        time = int(vehicle.get('depart'))
+        edge = vehicle.find('route').get('edges').split(" ")[0]
         array.append((edge, time, type))
         edges.add(edge)
         types.add(type)
@@ -0,0 +1,91 @@
+import numpy as np
+from Utils.Backend import backend as traci
+
+
+class VehicleRegistry:
+    '''
+    Network wide registry of the static vehicle metadata.
+    Vehicles are added when they depart and evicted when they arrive, vClass, type and length never change
+    during a vehicle's life so they are queried once (once per vehicle type) and kept in arrays indexed by an integer handle.
+    '''
+    vclasses = ['other', 'passenger', 'bus', 'emergency', 'truck', 'trailer', 'delivery', 'motorcycle', 'bicycle']
+
+    def __init__(self, capacity=1024):
+        self.handles = dict()
+        self.free = list()
+        self.vclass = np.zeros(capacity, dtype=np.int8)
+        self.vtype = np.zeros(capacity, dtype=np.int32)
+        self.length = np.zeros(capacity, dtype=np.float32)
+        self.types = list()
+        self.types_info = dict()
+
+    def __len__(self):
+        return len(self.handles)
+
+    def clear(self):
+        self.handles = dict()
+        self.free = list()
+
+    def _grow(self):
+        capacity = 2 * len(self.vclass)
+        self.vclass = np.resize(self.vclass, capacity)
+        self.vtype = np.resize(self.vtype, capacity)
+        self.length = np.resize(self.length, capacity)
+
+    def _type_info(self, type_id):
+        """ Returns (type handle, vClass code, length) of a vehicle type, queried once per type """
+        if type_id not in self.types_info:
+            vclass = traci.vehicletype.getVehicleClass(type_id)
+            code = VehicleRegistry.vclasses.index(vclass) if vclass in VehicleRegistry.vclasses else 0
+            self.types_info[type_id] = (len(self.types), code, traci.vehicletype.getLength(type_id))
+            self.types.append(type_id)
+        return self.types_info[type_id]
+
+    def add(self, vid):
+        if vid in self.handles:
+            return self.handles[vid]
+        if len(self.free) > 0:
+            handle = self.free.pop()
+        else:
+            handle = len(self.handles)
+            if handle >= len(self.vclass):
+                self._grow()
+        self.vtype[handle], self.vclass[handle], self.length[handle] = self._type_info(traci.vehicle.getTypeID(vid))
+        self.handles[vid] = handle
+        return handle
+
+    def remove(self, vid):
+        handle = self.handles.pop(vid, None)
+        if handle is not None:
+            self.free.append(handle)
+
+    def update(self, departed, arrived):
+        """ Apply the departed and arrived vehicles of the last simulation step """
+        for vid in arrived:
+            self.remove(vid)
+        for vid in departed:
+            self.add(vid)
+
+    def sync(self, vids):
+        """ Match the vehicles in the simulation: evict the ones that left and add the ones that departed unreported """
+        vids = set(vids)
+        for vid in [vid for vid in self.handles if vid not in vids]:
+            self.remove(vid)
+        for vid in vids:
+            self.add(vid)
+
+    def handle(self, vid):
+        """ Vehicles that departed before the registry was filled (e.g. loaded from a saved state) are added on first lookup """
+        handle = self.handles.get(vid)
+        if handle is None:
+            handle = self.add(vid)
+        return handle
+
+    def get_class(self, vid):
+        return VehicleRegistry.vclasses[self.vclass[self.handle(vid)]]
+
+    def get_type(self, vid):
+        return self.types[self.vtype[self.handle(vid)]]
+
+    def get_length(self, vid):
+        return float(self.length[self.handle(vid)])
@@ -0,0 +1,59 @@
+import unittest
+from types import SimpleNamespace
+
+try:
+    from Utils.Backend import backend
+    from TrafficNetwork import TrafficNetwork
+    missing = None
+except ImportError as error:
+    missing = str(error)
+
+
+class FakeSumo:
+    """ The part of the traci API used by TrafficNetwork.fast_forward, vehicles are loaded route_steps ahead """
+    def __init__(self, departures, route_steps=200):
+        self.time = 0
+        self.departures = departures
+        self.route_steps = route_steps
+        self.simulation = SimpleNamespace(getMinExpectedNumber=self.min_expected_number)
+
+    def min_expected_number(self):
+        return len([depart for depart in self.departures if depart <= self.time + self.route_steps])
+
+    def in_network(self):
+        return len([depart for depart in self.departures if depart <= self.time])
+
+    def simulationStep(self, step=0):
+        # Like SUMO, runs every second up to step
+        self.time = max(step, self.time + 1)
+
+
+@unittest.skipIf(missing is not None, "missing dependencies: " + str(missing))
+class FastForwardTest(unittest.TestCase):
+    def setUp(self):
+        self.module = backend.module
+
+    def tearDown(self):
+        backend.module = self.module
+
+    def fast_forward(self, departures, end_time=3600, stride=60):
+        sumo = FakeSumo(departures)
+        backend.module = sumo
+        network = TrafficNetwork.__new__(TrafficNetwork)
+        network.args = SimpleNamespace(dump=False)
+        network.junctions = []
+        network.observation = SimpleNamespace(time=sumo.time)
+        network.is_idle = lambda: sumo.in_network() == 0
+        network.observe = lambda: setattr(network.observation, 'time', sumo.time)
+        return network.fast_forward(end_time, stride)
+
+    def test_returns_when_the_first_vehicle_appears(self):
+        self.assertEqual(self.fast_forward([137]), 137)
+        self.assertEqual(self.fast_forward([1000, 1001]), 1000)
+
+    def test_strides_to_the_end_of_an_empty_episode(self):
+        self.assertEqual(self.fast_forward([], end_time=3600), 3600)
+
+
+if __name__ == '__main__':
+    unittest.main()